@@ -15,8 +15,10 @@ def polish():
         with settings(hide('running'), warn_only=True):
             # Remove compiled python classes
             info('Removing compiled python classes...')
-            local('pyclean ./r5d4 ./tests ./scripts fabfile.py run.py')
+            local('pyclean ./r5d4 ./tests ./scripts fabfile.py run.py '
+                  'run_gevent.py')
             local('find ./r5d4 ./tests ./scripts fabfile.py run.py '
+                  'run_gevent.py '
                   '-name "*.py[co]" -print0 | xargs -0 rm -f')
 
             # Fix file permissions
@@ -28,7 +30,9 @@ def polish():
                   '-name "analytics_manager.py" -o '
                   '-name "analytics_worker.py" -o '
                   '-name "run.py" -o '
+                  '-name "run_gevent.py" -o '
                   '-wholename "./scripts/add_keys.py" -o '
+                  '-wholename "./tests/benchmark.py" -o '
                   '-wholename "./tests/publish.py" -o '
                   '-wholename "./tests/run_tests.py" \) '
                   '-exec chmod 0755 {} \\; -o '
@@ -37,11 +41,13 @@ def polish():
 
             # Run coding standards check
             info('Running coding standards check...')
-            local('pep8 ./r5d4 ./tests ./scripts fabfile.py run.py')
+            local('pep8 ./r5d4 ./tests ./scripts fabfile.py run.py '
+                  'run_gevent.py')
 
             # Run static code analyzer
             info('Running static code analyzer...')
-            local('pyflakes ./r5d4 ./tests ./scripts fabfile.py run.py')
+            local('pyflakes ./r5d4 ./tests ./scripts fabfile.py run.py '
+                  'run_gevent.py')
 
             # Find merge conflict leftovers
             info('Finding merge conflict leftovers...')
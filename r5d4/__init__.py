@@ -1,10 +1,12 @@
 from __future__ import absolute_import
-from flask import Flask, request, Response, json
+from flask import Flask, request, Response, json, jsonify, \
+    stream_with_context
 from werkzeug.exceptions import BadRequest
 import r5d4.settings as settings
 from r5d4.analytics_browser import browse_analytics
-from r5d4.publisher import publish_transaction
-from r5d4.utility import json_response
+from r5d4.publisher import publish_transaction, publish_transactions, \
+    parse_transactions
+from r5d4.utility import iter_json, iter_ndjson
 from r5d4.logger import get_activity_log
 
 app = Flask(__name__)
@@ -16,6 +18,13 @@ app.config["REDIS_PORT"] = settings.REDIS_PORT
 app.config["CONFIG_DB"] = settings.CONFIG_DB
 app.config["DEFAULT_DATA_DB"] = settings.DEFAULT_DATA_DB
 app.config["SECRET_KEY"] = settings.SECRET_KEY
+app.config["WORKER_DISPATCHERS"] = settings.WORKER_DISPATCHERS
+app.config["WORKER_RELOAD_INTERVAL"] = settings.WORKER_RELOAD_INTERVAL
+app.config["QUEUE_MAX_LENGTH"] = settings.QUEUE_MAX_LENGTH
+app.config["QUERY_CACHE_SIZE"] = settings.QUERY_CACHE_SIZE
+app.config["QUERY_CACHE_TTL"] = settings.QUERY_CACHE_TTL
+app.config["QUERY_CACHE_PAST_TTL"] = settings.QUERY_CACHE_PAST_TTL
+app.config["BROWSE_STREAM_ROWS"] = settings.BROWSE_STREAM_ROWS
 activity_log = get_activity_log()
 
 
@@ -54,9 +63,22 @@ def service_unavailable_handler(error):
 
 
 @app.route('/analytics/<analytics_name>/', methods=['GET'])
-@json_response
 def analytics(analytics_name):
-    return browse_analytics(analytics_name, request.args)
+    # Rows are sent one JSON document per line when asked for NDJSON
+    ndjson = request.accept_mimetypes.best_match(
+        ["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+    result = browse_analytics(analytics_name, request.args, stream=ndjson)
+    if ndjson:
+        batches = result["data"]
+        if isinstance(batches, list):
+            # Served from the query cache
+            batches = [batches]
+        return Response(stream_with_context(iter_ndjson(batches)),
+                        mimetype='application/x-ndjson')
+    if isinstance(result["data"], list):
+        return jsonify(result)
+    return Response(stream_with_context(iter_json(result, "data")),
+                    mimetype='application/json')
 
 
 @app.route('/resource/<resource>/', methods=['POST'])
@@ -72,3 +94,21 @@ def publish(resource):
     return Response(status=202, mimetype='application/json',
                     response=json.dumps({"status": "Accepted"},
                                         indent=2))
+
+
+@app.route('/resource/<resource>/bulk/', methods=['POST'])
+def publish_bulk(resource):
+    try:
+        # Raw body, also when it was sent form-encoded
+        transactions = parse_transactions(request.get_data())
+        listened = publish_transactions(resource, transactions)
+        if activity_log:
+            for tr_type, payload in transactions:
+                activity_log.info("%s\t%s\t%s", tr_type, resource, payload)
+    except ValueError as e:
+        raise BadRequest(e.args)
+    return Response(status=202, mimetype='application/json',
+                    response=json.dumps({"status": "Accepted",
+                                         "accepted": len(listened),
+                                         "listened": listened},
+                                        indent=2))
@@ -4,9 +4,16 @@ import sys
 import json
 from r5d4.mapping_functions import MEASURING_FUNCTIONS_MAP,\
     DIMENSION_PARSERS_MAP, CONDITION_KEYS
+from r5d4.analytics_plan import AnalyticsPlan
 
 TOP_KEYS = ["name", "description", "query_dimensions", "slice_dimensions",
-            "data_db", "measures", "mapping"]
+            "data_db", "measures", "mapping", "batch_size", "batch_timeout",
+            "aggregation", "invalidate_cache", "transport", "workers",
+            "partition_by", "refcount_index", "rollups", "storage"]
+AGGREGATION_MODES = ["client", "server"]
+TRANSPORTS = ["pubsub", "queue"]
+DATE_BUCKETS = ["week", "month", "year"]
+STORAGE_LAYOUTS = ["keys", "hash"]
 
 
 class Analytics:
@@ -54,6 +61,51 @@ class Analytics:
             assert top_key in TOP_KEYS, \
                 "Definition has unexpected key '%(top_key)s'" % locals()
 
+        # Checking batching options
+        if "batch_size" in self.definition:
+            assert type(self.definition["batch_size"]) == int and \
+                self.definition["batch_size"] > 0, \
+                "'batch_size' should be a positive integer"
+        if "batch_timeout" in self.definition:
+            assert type(self.definition["batch_timeout"]) in (int, float) \
+                and self.definition["batch_timeout"] >= 0, \
+                "'batch_timeout' should be a non-negative number of " \
+                "milliseconds"
+
+        # Checking where snoq aggregation happens
+        if "aggregation" in self.definition:
+            assert self.definition["aggregation"] in AGGREGATION_MODES, \
+                "'aggregation' should be one of [%s]" % \
+                ",".join(AGGREGATION_MODES)
+
+        if "invalidate_cache" in self.definition:
+            assert type(self.definition["invalidate_cache"]) == bool, \
+                "'invalidate_cache' should be true or false"
+
+        # Checking how transactions reach the worker
+        if "transport" in self.definition:
+            assert self.definition["transport"] in TRANSPORTS, \
+                "'transport' should be one of [%s]" % ",".join(TRANSPORTS)
+
+        # Checking sharding options
+        if "workers" in self.definition:
+            assert type(self.definition["workers"]) == int and \
+                self.definition["workers"] > 0, \
+                "'workers' should be a positive integer"
+            assert self.definition["workers"] == 1 or \
+                "partition_by" in self.definition, \
+                "'workers' > 1 needs a 'partition_by' dimension"
+        if "partition_by" in self.definition:
+            # RefCount hashes of a qnos dimension are keyed by the slice
+            # and hold every value of it, so only one shard may write them
+            qnos_dimensions = set(self.definition["query_dimensions"]) - \
+                set(self.definition["slice_dimensions"])
+            assert self.definition["partition_by"] in \
+                self.definition["slice_dimensions"] or \
+                qnos_dimensions == set([self.definition["partition_by"]]), \
+                "'partition_by' should be a slice dimension or the only " \
+                "query dimension that isn't one"
+
         mapping = self.definition["mapping"]
         mapped_measures = set()
         mapped_dimensions = set()
@@ -84,10 +136,11 @@ class Analytics:
                 assert "field" in mapping[measure], \
                     "Measure '%s' has type 'score' but missing 'field'" % \
                     measure
-            if mapping[measure]["type"] == "unique":
+            if mapping[measure]["type"] in ("unique", "unique_approx"):
                 assert "field" in mapping[measure], \
-                    "Measure '%s' has type 'unique' but missing 'field'" % \
-                    measure
+                    "Measure '%s' has type '%s' but missing 'field'" % (
+                        measure,
+                        mapping[measure]["type"])
             if "conditions" in mapping[measure]:
                 for condition in mapping[measure]["conditions"]:
                     assert "field" in condition, \
@@ -123,10 +176,53 @@ class Analytics:
             assert "field" in mapping[dimension], \
                 "Dimension '%s' is missing 'field'" % dimension
 
+        # Checking options bucketing the daily slice dimension
+        date_dimensions = [d for d in self.definition["slice_dimensions"]
+                           if mapping[d]["type"] == "date"]
+        if "refcount_index" in self.definition:
+            assert self.definition["refcount_index"] in DATE_BUCKETS, \
+                "'refcount_index' should be one of [%s]" % \
+                ",".join(DATE_BUCKETS)
+            assert len(date_dimensions) == 1, \
+                "'refcount_index' needs exactly one slice dimension of " \
+                "type 'date'"
+            # Days of a bucket would be written by different shards, which
+            # can't remove an index field at 0 without racing each other
+            assert self.definition.get("partition_by") != \
+                date_dimensions[0], \
+                "'refcount_index' needs a 'partition_by' other than the " \
+                "'date' slice dimension"
+        if "rollups" in self.definition:
+            rollups = self.definition["rollups"]
+            assert type(rollups) == list and len(rollups) > 0 and \
+                set(rollups) <= set(DATE_BUCKETS), \
+                "'rollups' should be a list of [%s]" % ",".join(DATE_BUCKETS)
+            assert len(date_dimensions) == 1 and date_dimensions[0] not in \
+                self.definition["query_dimensions"], \
+                "'rollups' needs exactly one slice dimension of type " \
+                "'date', not also a query dimension"
+
+        # Checking where counters are stored
+        if "storage" in self.definition:
+            assert self.definition["storage"] in STORAGE_LAYOUTS, \
+                "'storage' should be one of [%s]" % ",".join(STORAGE_LAYOUTS)
+        if self.definition.get("storage") == "hash":
+            assert len(date_dimensions) == 1, \
+                "'storage' 'hash' needs exactly one slice dimension of type " \
+                "'date'"
+            assert self.definition.get("aggregation") != "server", \
+                "'aggregation' 'server' needs 'storage' 'keys'"
+
         unmapped = set(mapping.keys()) - (mapped_measures | mapped_dimensions)
         assert unmapped == set(), \
             "Unmapped keys in mapping: [%s]" % ",".join(unmapped)
 
+    def compile(self):
+        """
+        Compiles the Analytics into an AnalyticsPlan for the worker
+        """
+        return AnalyticsPlan(self)
+
     def set_data_db(self, data_db):
         self.definition["data_db"] = data_db
 
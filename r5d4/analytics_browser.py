@@ -1,40 +1,330 @@
 from __future__ import absolute_import
-from flask import abort
+from datetime import datetime, timedelta
+from itertools import imap, izip, product
+from flask import abort, current_app
 from werkzeug.exceptions import ServiceUnavailable
 from r5d4.analytics import Analytics
+from r5d4.analytics_plan import refcount_index, rollups, hash_layout
 from r5d4.flask_redis import get_conf_db, get_data_db
-from r5d4.mapping_functions import DIMENSION_EXPANSION_MAP
-from r5d4.utility import construct_key
+from r5d4.key_builder import key_fragment, join_key
+from r5d4.mapping_functions import DIMENSION_EXPANSION_MAP,\
+    DIMENSION_PARSERS_MAP, DATE_DIMENSION_TYPES
+from r5d4.query_cache import get_query_cache
+from r5d4.utility import construct_key, chunks, concurrent_map
 
+# Number of keys fetched per MGET or pipeline
+FETCH_CHUNK_SIZE = 1000
+# Chunks fetched at once per call under gevent, on a connection each
+FETCH_CONCURRENCY = 8
 
-def combinatorial_keys(rem_range):
+# Sums consecutive groups of ARGV[1] keys inside Redis. A group where none
+# of the keys exist gives nil, as the client-side aggregation would. Keys
+# are read with an MGET per ARGV[2] of them, as unpack() can't pass more
+# than a few thousand arguments.
+SUM_GROUPS_SCRIPT = """
+local size = tonumber(ARGV[1])
+local slice = tonumber(ARGV[2])
+local values = {}
+for first = 1, #KEYS, slice do
+    local last = math.min(first + slice - 1, #KEYS)
+    local slice_values = redis.call('MGET', unpack(KEYS, first, last))
+    for i = 1, #slice_values do
+        values[first + i - 1] = slice_values[i]
+    end
+end
+local sums = {}
+for g = 0, #KEYS / size - 1 do
+    local sum = false
+    for i = g * size + 1, (g + 1) * size do
+        if values[i] then
+            sum = (sum or 0) + tonumber(values[i])
+        end
+    end
+    if sum then
+        sums[g + 1] = string.format('%.17g', sum)
+    else
+        sums[g + 1] = false
+    end
+end
+return sums
+"""
+
+
+def dimension_fragments(d_range):
+    """
+    Key fragments of the values of each dimension in d_range
+    """
+    return [[key_fragment(dimension, value) for value in values]
+            for dimension, values in d_range]
+
+
+def combinatorial_keys(d_range):
     """
+    Yields (values, key_str) for every combination of values of the
+    dimensions in d_range. The key fragments of each dimension are built
+    once and key_str only joins them.
+
     >>> list(combinatorial_keys([("d1", [1,2]), ("d2", [3,4])])) == \
-      [('d1', 1, 'd2', 3), ('d1', 1, 'd2', 4), ('d1', 2, 'd2', 3), \
-       ('d1', 2, 'd2', 4)]
+      [((1, 3), 'd1:1:d2:3'), ((1, 4), 'd1:1:d2:4'), \
+       ((2, 3), 'd1:2:d2:3'), ((2, 4), 'd1:2:d2:4')]
+    True
+    >>> list(combinatorial_keys([]))
+    [((), '')]
+    """
+    value_lists = [values for dimension, values in d_range]
+    return izip(product(*value_lists),
+                imap(':'.join, product(*dimension_fragments(d_range))))
+
+
+def fetch_values(data_db, keys):
+    """
+    Fetches the values of string keys with chunked MGETs
+    """
+    values = []
+    for chunk_values in concurrent_map(data_db.mget,
+                                       chunks(keys, FETCH_CHUNK_SIZE),
+                                       FETCH_CONCURRENCY):
+        values.extend(chunk_values)
+    return values
+
+
+def fetch_hash_values(data_db, keys, layout):
+    """
+    Fetches the values of counters stored in hashes, located by layout,
+    with chunked pipelines of one HMGET per hash
+    """
+    def fetch_chunk(chunk):
+        locations = map(layout.locate, chunk)
+        hash_fields = {}
+        for hash_key, field in locations:
+            hash_fields.setdefault(hash_key, []).append(field)
+        pipe = data_db.pipeline(transaction=False)
+        for hash_key, fields in hash_fields.iteritems():
+            pipe.hmget(hash_key, fields)
+        values = {}
+        for (hash_key, fields), hash_values in \
+                zip(hash_fields.iteritems(), pipe.execute()):
+            for field, value in zip(fields, hash_values):
+                values[(hash_key, field)] = value
+        return map(values.get, locations)
+
+    values = []
+    for chunk_values in concurrent_map(fetch_chunk,
+                                       chunks(keys, FETCH_CHUNK_SIZE),
+                                       FETCH_CONCURRENCY):
+        values.extend(chunk_values)
+    return values
+
+
+def fetch_cardinalities(data_db, keys):
+    """
+    Fetches the cardinalities of set keys with chunked SCARD pipelines
+    """
+    def fetch_chunk(chunk):
+        pipe = data_db.pipeline(transaction=False)
+        for key in chunk:
+            pipe.scard(key)
+        return pipe.execute()
+
+    values = []
+    for chunk_values in concurrent_map(fetch_chunk,
+                                       chunks(keys, FETCH_CHUNK_SIZE),
+                                       FETCH_CONCURRENCY):
+        values.extend(chunk_values)
+    return values
+
+
+def fetch_hash_fields(data_db, keys):
+    """
+    Fetches the union of the fields of hash keys with chunked HKEYS
+    pipelines
+    """
+    def fetch_chunk(chunk):
+        pipe = data_db.pipeline(transaction=False)
+        for key in chunk:
+            pipe.hkeys(key)
+        return pipe.execute()
+
+    fields = set()
+    for chunk_fields in concurrent_map(fetch_chunk,
+                                       chunks(keys, FETCH_CHUNK_SIZE),
+                                       FETCH_CONCURRENCY):
+        for key_fields in chunk_fields:
+            fields.update(key_fields)
+    return fields
+
+
+def fetch_group_sums(data_db, keys, group_size):
+    """
+    Fetches the sums of consecutive groups of group_size keys, computed in
+    Redis by SUM_GROUPS_SCRIPT. Returns one value per group.
+    """
+    sum_groups = data_db.register_script(SUM_GROUPS_SCRIPT)
+    groups_per_chunk = max(1, FETCH_CHUNK_SIZE // group_size)
+    values = []
+    for chunk_values in concurrent_map(
+            lambda chunk: sum_groups(keys=chunk,
+                                     args=[group_size, FETCH_CHUNK_SIZE]),
+            chunks(keys, groups_per_chunk * group_size), FETCH_CONCURRENCY):
+        values.extend(chunk_values)
+    return values
+
+
+def fetch_approx_cardinalities(data_db, keys, group_size):
+    """
+    Fetches the estimated cardinalities of the unions of consecutive groups
+    of group_size HyperLogLog keys with chunked PFCOUNT pipelines. Returns
+    one value per group.
+    """
+    def fetch_chunk(chunk):
+        pipe = data_db.pipeline(transaction=False)
+        for i in xrange(0, len(chunk), group_size):
+            pipe.pfcount(*chunk[i:i + group_size])
+        return pipe.execute()
+
+    groups_per_chunk = max(1, FETCH_CHUNK_SIZE // group_size)
+    values = []
+    for chunk_values in concurrent_map(
+            fetch_chunk, chunks(keys, groups_per_chunk * group_size),
+            FETCH_CONCURRENCY):
+        values.extend(chunk_values)
+    return values
+
+
+def days_in_bucket(bucket, parse_bucket):
+    """
+    Number of days in the bucket starting on the day bucket
+
+    >>> from r5d4.mapping_functions import parse_month, parse_week
+    >>> days_in_bucket("20120201", parse_month)
+    29
+    >>> days_in_bucket("20111226", parse_week)
+    7
+    """
+    day = datetime.strptime(bucket, "%Y%m%d")
+    days = 0
+    while parse_bucket(day.strftime("%Y%m%d")) == bucket:
+        days += 1
+        day += timedelta(days=1)
+    return days
+
+
+def split_by_bucket(days, parse_bucket):
+    """
+    Splits days into the buckets they cover entirely and the days left
+
+    >>> from r5d4.mapping_functions import parse_month
+    >>> split_by_bucket(["201102%02d" % d for d in range(1, 29)] +
+    ...                 ["20110301", "20110302"], parse_month)
+    (['20110201'], ['20110301', '20110302'])
+    """
+    days_by_bucket = {}
+    for day in days:
+        days_by_bucket.setdefault(parse_bucket(day), []).append(day)
+    buckets = []
+    partial_days = []
+    for bucket, bucket_days in sorted(days_by_bucket.iteritems()):
+        if len(bucket_days) == days_in_bucket(bucket, parse_bucket):
+            buckets.append(bucket)
+        else:
+            partial_days.extend(bucket_days)
+    return buckets, sorted(partial_days)
+
+
+def cover_days(dimension, days, buckets):
+    """
+    Key fragments covering days with few keys: every bucket, coarsest
+    first, that the days not covered yet fill entirely, then the days left.
+    buckets are (label, parse_bucket) pairs.
+
+    >>> from r5d4.mapping_functions import parse_month, parse_year
+    >>> cover_days("date", ["201102%02d" % d for d in range(1, 29)] +
+    ...            ["20110301"], [("date/year", parse_year),
+    ...                           ("date/month", parse_month)])
+    ['date/month:20110201', 'date:20110301']
+    """
+    fragments = []
+    for label, parse_bucket in buckets:
+        covered, days = split_by_bucket(days, parse_bucket)
+        fragments.extend(key_fragment(label, bucket) for bucket in covered)
+    fragments.extend(key_fragment(dimension, day) for day in days)
+    return fragments
+
+
+def in_past(mapping, d_range):
+    """
+    True if the range has date dimensions and all their values lie before
+    the bucket containing today, such data is not expected to change.
+
+    >>> mapping = {"date": {"type": "date"}, "practice": {"type": "integer"}}
+    >>> in_past(mapping, [("date", set(["20111001", "20111002"])),
+    ...                   ("practice", set(["1"]))])
     True
+
+    >>> in_past(mapping, [("date", set(["20111001", "99991231"]))])
+    False
+
+    >>> in_past(mapping, [("practice", set(["1"]))])
+    False
     """
-    if not rem_range:
-        yield ()
-        return
-    dimension, dim_range = rem_range[0]
-    for dim_value in dim_range:
-        for rest_key in combinatorial_keys(rem_range[1:]):
-            yield (dimension, dim_value) + rest_key
-    return
+    today = datetime.now().strftime("%Y-%m-%d")
+    has_date_dimension = False
+    for d, value_set in d_range:
+        d_type = mapping[d]["type"]
+        if d_type not in DATE_DIMENSION_TYPES:
+            continue
+        has_date_dimension = True
+        current_bucket = DIMENSION_PARSERS_MAP[d_type](today)
+        if not value_set or max(value_set) >= current_bucket:
+            return False
+    return has_date_dimension
+
+
+def get_definition_cache(app=current_app):
+    if not hasattr(app, 'definition_cache'):
+        app.definition_cache = {}
+    return app.definition_cache
 
 
-def browse_analytics(a_name, slice_args):
+def get_analytics(a_name):
+    """
+    Returns (analytics, stamp) for an active analytics, stamp changes
+    whenever its definition or status does. Aborts with 404 otherwise.
+    Validated definitions are cached per process until their version key,
+    bumped by AnalyticsManager, changes.
+    """
     conf_db = get_conf_db()
-    if not conf_db.sismember("Analytics:Active", a_name):
-        abort(404)
-    analytics_definition = conf_db.get("Analytics:ByName:%s" % a_name)
-    if analytics_definition is None:
+    definition_cache = get_definition_cache()
+    version = conf_db.get("Analytics:ByName:%s:Version" % a_name)
+    if version is not None and a_name in definition_cache:
+        cached_version, analytics = definition_cache[a_name]
+        if cached_version == version:
+            if analytics is None:
+                abort(404)
+            return analytics, version
+
+    analytics = None
+    if conf_db.sismember("Analytics:Active", a_name):
+        analytics_definition = conf_db.get("Analytics:ByName:%s" % a_name)
+        if analytics_definition is not None:
+            try:
+                analytics = Analytics(analytics_definition)
+            except (ValueError, AssertionError) as e:
+                raise ServiceUnavailable(e.args)
+    if version is not None:
+        definition_cache[a_name] = (version, analytics)
+    if analytics is None:
         abort(404)
-    try:
-        analytics = Analytics(analytics_definition)
-    except (ValueError, AssertionError) as e:
-        raise ServiceUnavailable(e.args)
+    return analytics, version or analytics_definition
+
+
+def browse_analytics(a_name, slice_args, stream=False):
+    """
+    Returns the browse response for slice_args. When stream is True or the
+    result has more than BROWSE_STREAM_ROWS rows, "data" is an iterator of
+    lists of rows, computed a batch at a time, and the result isn't cached.
+    """
+    analytics, analytics_stamp = get_analytics(a_name)
     data_db = get_data_db(analytics["data_db"])
 
     mapping = analytics["mapping"]
@@ -55,6 +345,21 @@ def browse_analytics(a_name, slice_args):
 
     d_range_dict = dict(d_range)
 
+    # Serving repeated queries from the result cache
+    query_cache = get_query_cache()
+    cache_key = (a_name, analytics_stamp, tuple(sorted(
+        (d, tuple(sorted(value_set))) for d, value_set in d_range)))
+    generation = None
+    if analytics["invalidate_cache"]:
+        generation = data_db.get(construct_key("Generation", a_name))
+    output_response = query_cache.get(cache_key, generation)
+    if output_response is not None:
+        return output_response
+    if in_past(mapping, d_range):
+        cache_ttl = current_app.config["QUERY_CACHE_PAST_TTL"]
+    else:
+        cache_ttl = current_app.config["QUERY_CACHE_TTL"]
+
     def get_range(dimensions):
         d_range = map(lambda d: (d, sorted(list(d_range_dict[d]))),
                       sorted(list(dimensions)))
@@ -66,64 +371,133 @@ def browse_analytics(a_name, slice_args):
     s_range = get_range(slice_dimensions)
     snoq_range = get_range(snoq_dimensions)
 
+    # RefCount hashes list the qnos values present in each slice. With a
+    # RefCount index, buckets of days the range covers are read at once.
+    refcount_ranges = [('RefCount', s_range)]
+    index = refcount_index(analytics)
+    if index is not None and qnos_dimensions:
+        index_dimension, parse_bucket = index
+        buckets, days = split_by_bucket(d_range_dict[index_dimension],
+                                        parse_bucket)
+        refcount_ranges = [
+            (prefix, [(d, bucket_values if d == index_dimension else values)
+                      for d, values in s_range])
+            for prefix, bucket_values in (('RefCountIndex', buckets),
+                                          ('RefCount', days))]
+
     for qnos in qnos_dimensions:
-        d_range_dict[qnos] = set()
-        for s_key in combinatorial_keys(s_range):
-            refcount_key_str = construct_key('RefCount', s_key, qnos)
-            d_range_dict[qnos] |= set(data_db.hkeys(refcount_key_str))
+        refcount_keys = [join_key(prefix, key_str, qnos)
+                         for prefix, r_range in refcount_ranges
+                         for values, key_str in combinatorial_keys(r_range)]
+        d_range_dict[qnos] = fetch_hash_fields(data_db, refcount_keys)
 
     q_range = get_range(query_dimensions)
-    output = []
-    for q_key in combinatorial_keys(q_range):
-        row = {}
-        key_is_set = False
-        key = None
-        for q in q_key:  # q_key=(Date,20110808,Practice,1)
-            if not key_is_set:
-                key = q
-                key_is_set = True
-            else:
-                row[key] = q
-                key_is_set = False
+    q_dimensions = [d for d, values in q_range]
+    q_keys = combinatorial_keys(q_range)
+    row_count = 1
+    for d, values in q_range:
+        row_count *= len(values)
+    snoq_fragments = dimension_fragments(snoq_range)
+    rollup = rollups(analytics)
+    if rollup is not None:
+        # Rolled up measures are read per bucket where the range allows
+        rollup_dimension, buckets = rollup
+        for i, (d, values) in enumerate(snoq_range):
+            if d == rollup_dimension:
+                snoq_fragments[i] = cover_days(d, values, buckets)
+    snoq_keys = map(':'.join, product(*snoq_fragments))
+    if len(snoq_keys) == 0:
+        snoq_keys = ['']
+    # Appended as is to every "<measure>:<q_key>" prefix
+    snoq_suffixes = [':' + snoq_key_str if snoq_key_str else ''
+                     for snoq_key_str in snoq_keys]
 
+    if len(snoq_keys) > 1 and row_count:
         for measure in measures:
-            if mapping[measure]["type"][-5:] == "float":
-                is_float = True
-            else:
-                is_float = False
-            row[measure] = 0
-            snoq_keys = list(combinatorial_keys(snoq_range))
-            if len(snoq_keys) < 2:
-                if len(snoq_keys) == 1:
-                    snoq_key = snoq_keys[0]
-                else:
-                    snoq_key = None
-                val_key = construct_key(measure, q_key, snoq_key)
-                if mapping[measure]["type"] == "unique":
-                    val = data_db.scard(val_key)
+            if mapping[measure]["type"] == "unique":
+                abort(400, ("Measure type 'unique' cannot be aggregated"))
+
+    server_aggregation = analytics["aggregation"] == "server" and \
+        len(snoq_keys) > 1
+    if server_aggregation:
+        vals_per_measure = 1
+    else:
+        vals_per_measure = len(snoq_keys)
+
+    # Measures are fetched by kind, with the number of values each gives
+    # per row: counters, sets, and HyperLogLogs counted over all snoq keys
+    vals_per_kind = {
+        "value": vals_per_measure,
+        "unique": len(snoq_keys),
+        "unique_approx": 1
+    }
+    layout = hash_layout(analytics)
+    measure_kinds = {}
+    for measure in measures:
+        measure_kinds[measure] = mapping[measure]["type"]
+        if measure_kinds[measure] not in vals_per_kind:
+            measure_kinds[measure] = "value"
+
+    def build_rows(q_keys):
+        # Enumerating all the keys needed before fetching them in bulk, in a
+        # single pass so q_keys can be a generator
+        output = []
+        kind_keys = dict((kind, []) for kind in vals_per_kind)
+        measure_keys = [(measure, kind_keys[measure_kinds[measure]])
+                        for measure in measures]
+        for q_values, q_key_str in q_keys:  # q_values=(20110808,1)
+            output.append(dict(zip(q_dimensions, q_values)))
+            for measure, keys in measure_keys:
+                prefix = join_key(measure, q_key_str)
+                keys.extend([prefix + suffix for suffix in snoq_suffixes])
+
+        def fetch(kind):
+            keys = kind_keys[kind]
+            if kind == "unique":
+                return fetch_cardinalities(data_db, keys)
+            if kind == "unique_approx":
+                return fetch_approx_cardinalities(data_db, keys,
+                                                  len(snoq_keys))
+            if server_aggregation:
+                # Each group of snoq keys is summed next to the data
+                return fetch_group_sums(data_db, keys, len(snoq_keys))
+            if layout is not None:
+                return fetch_hash_values(data_db, keys, layout)
+            return fetch_values(data_db, keys)
+        # Each kind is fetched concurrently under gevent
+        kinds = sorted(kind_keys)
+        kind_vals = dict(zip(kinds, map(iter, concurrent_map(
+            fetch, kinds, FETCH_CONCURRENCY))))
+
+        for row in output:
+            for measure in measures:
+                if mapping[measure]["type"][-5:] == "float":
+                    convert = float
                 else:
-                    val = data_db.get(val_key)
-                if val:
-                    if is_float:
-                        row[measure] = float(val)
-                    else:
-                        row[measure] = int(val)
-            else:
-                for snoq_key in snoq_keys:
-                    val_key = construct_key(measure, q_key, snoq_key)
-                    if mapping[measure]["type"] == "unique":
-                        abort(400, (
-                            "Measure type 'unique' cannot be aggregated"))
-                    else:
-                        val = data_db.get(val_key)
+                    convert = int
+                kind = measure_kinds[measure]
+                measure_vals = kind_vals[kind]
+                row[measure] = 0
+                for i in xrange(vals_per_kind[kind]):
+                    val = next(measure_vals)
                     if val:
-                        if is_float:
-                            row[measure] += float(val)
-                        else:
-                            row[measure] += int(val)
-        output.append(row)
+                        row[measure] += convert(val)
+        return output
+
+    if stream or row_count > current_app.config["BROWSE_STREAM_ROWS"]:
+        # Rows are computed a chunk of keys at a time while being sent
+        keys_per_row = max(1, len(measures) * len(snoq_keys))
+        rows_per_batch = max(1, FETCH_CHUNK_SIZE // keys_per_row)
+
+        return {
+            "status": "OK",
+            "data": (build_rows(batch)
+                     for batch in chunks(q_keys, rows_per_batch))
+        }
+
     output_response = {
         "status": "OK",
-        "data": output
+        "data": build_rows(q_keys)
     }
+    query_cache.set(cache_key, output_response, cache_ttl, generation)
     return output_response
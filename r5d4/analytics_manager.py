@@ -1,15 +1,104 @@
 #!/usr/bin/env python
 from __future__ import absolute_import
+import json
+import re
 import sys
 from r5d4.analytics import Analytics
+from r5d4.analytics_plan import refcount_index, rollups
 from r5d4.settings import REDIS_UNIX_SOCKET_PATH, REDIS_HOST, REDIS_PORT, \
     CONFIG_DB
-from r5d4.flask_redis import get_conf_db
+from r5d4.flask_redis import get_conf_db, get_data_db
 from r5d4 import app
 
 
+def partition_spec(analytics):
+    """
+    Field and dimension type the publisher routes the transactions of a
+    sharded analytics by, as JSON
+    """
+    d = analytics["partition_by"]
+    return json.dumps([analytics["mapping"][d]["field"],
+                       analytics["mapping"][d]["type"]])
+
+
+def refcount_key_re(analytics, prefix, dimension):
+    """
+    Regular expression matching the RefCount keys of analytics written
+    under prefix, capturing the value of its daily slice dimension
+
+    >>> a = Analytics('{"name": "A", "measures": ["v"], '
+    ...               '"query_dimensions": ["date", "practice"], '
+    ...               '"slice_dimensions": ["date", "clinic"], '
+    ...               '"mapping": {"v": {"type": "count", "resource": "r"}, '
+    ...               '"date": {"type": "date", "field": "at"}, '
+    ...               '"clinic": {"type": "string", "field": "c"}, '
+    ...               '"practice": {"type": "integer", "field": "p"}}}')
+    >>> key_re = refcount_key_re(a, "RefCount", "date")
+    >>> key_re.match("RefCount:clinic:north:date:20111005:practice").group(1)
+    '20111005'
+
+    >>> key_re.match("RefCount:clinic:date:20111005:practice").group(1)
+    '20111005'
+
+    >>> key_re.match("RefCount:date:20111005:practice") is None
+    True
+    """
+    slice_dimensions = sorted(analytics["slice_dimensions"])
+    qnos_dimensions = sorted(set(analytics["query_dimensions"]) -
+                             set(slice_dimensions))
+    fragments = []
+    for d in slice_dimensions:
+        if d == dimension:
+            fragments.append(r"%s:(\d{8})" % re.escape(d))
+        else:
+            fragments.append(fragment_re(d))
+    return re.compile(r"^%s:%s:(?:%s)$" % (
+        re.escape(prefix), ":".join(fragments),
+        "|".join(map(re.escape, qnos_dimensions))))
+
+
+def fragment_re(dimension):
+    # Values have no ':', empty ones are written as the bare dimension name
+    return r"%s(?::[^:]*)?" % re.escape(dimension)
+
+
+def measure_key_re(analytics, measure, dimension):
+    """
+    Regular expression matching the keys of a measure of analytics, daily
+    or rolled up. Captures the name the daily slice dimension is written
+    under, the bucket part of it if any, and the day.
+
+    >>> a = Analytics('{"name": "A", "measures": ["v"], '
+    ...               '"query_dimensions": ["practice"], '
+    ...               '"slice_dimensions": ["date", "practice"], '
+    ...               '"mapping": {"v": {"type": "count", "resource": "r"}, '
+    ...               '"date": {"type": "date", "field": "at"}, '
+    ...               '"practice": {"type": "integer", "field": "p"}}}')
+    >>> key_re = measure_key_re(a, "v", "date")
+    >>> key_re.match("v:practice:1:date:20111005").groups()
+    ('date', None, '20111005')
+
+    >>> key_re.match("v:practice:1:date/month:20111001").groups()
+    ('date/month', '/month', '20111001')
+
+    >>> key_re.match("v:practice:1:clinic:north:date:20111005") is None
+    True
+    """
+    query_dimensions = sorted(analytics["query_dimensions"])
+    snoq_dimensions = sorted(set(analytics["slice_dimensions"]) -
+                             set(query_dimensions))
+    fragments = map(fragment_re, query_dimensions)
+    for d in snoq_dimensions:
+        if d == dimension:
+            fragments.append(r"(%s(/[a-z]+)?):(\d{8})" % re.escape(d))
+        else:
+            fragments.append(fragment_re(d))
+    return re.compile(r"^%s:%s$" % (re.escape(measure), ":".join(fragments)))
+
+
 class AnalyticsManager:
     def __init__(self, app):
+        self.app = app
         self.cdb = get_conf_db(app)
 
     def load_analytics(self, analytics, db=None):
@@ -21,7 +110,23 @@ class AnalyticsManager:
             resource = analytics["mapping"][measure]["resource"]
             self.cdb.sadd("Analytics:ByName:%s:Subscriptions" % name, resource)
             self.cdb.sadd("Subscriptions:%s:ActiveAnalytics" % resource, name)
+            if analytics["transport"] == "queue":
+                self.cdb.sadd("Subscriptions:%s:QueuedAnalytics" % resource,
+                              name)
+            else:
+                self.cdb.srem("Subscriptions:%s:QueuedAnalytics" % resource,
+                              name)
+            if analytics["workers"] > 1:
+                self.cdb.hset("Subscriptions:%s:Shards" % resource, name,
+                              analytics["workers"])
+                self.cdb.hset("Subscriptions:%s:Partitions" % resource, name,
+                              partition_spec(analytics))
+            else:
+                self.cdb.hdel("Subscriptions:%s:Shards" % resource, name)
+                self.cdb.hdel("Subscriptions:%s:Partitions" % resource,
+                              name)
         self.cdb.sadd("Analytics:Active", name)
+        self.cdb.incr("Analytics:ByName:%s:Version" % name)
         self.cdb.publish("AnalyticsWorkerCmd", "refresh")
 
     def dump_analytics(self, a_name=None):
@@ -38,6 +143,10 @@ class AnalyticsManager:
         subs = self.cdb.smembers("Analytics:ByName:%s:Subscriptions" % a_name)
         for sub in subs:
             self.cdb.srem("Subscriptions:%s:ActiveAnalytics" % sub, a_name)
+            self.cdb.srem("Subscriptions:%s:QueuedAnalytics" % sub, a_name)
+            self.cdb.hdel("Subscriptions:%s:Shards" % sub, a_name)
+            self.cdb.hdel("Subscriptions:%s:Partitions" % sub, a_name)
+        self.cdb.incr("Analytics:ByName:%s:Version" % a_name)
         self.cdb.publish("AnalyticsWorkerCmd", "refresh")
 
     def enable_analytics(self, a_name):
@@ -46,12 +155,150 @@ class AnalyticsManager:
                 "Analytics is not loaded.\n"
                 "Use 'load' command and the analytics json file\n"
             )
+            return
         self.cdb.sadd("Analytics:Active", a_name)
+        analytics = Analytics(self.cdb.get("Analytics:ByName:%s" % a_name))
         subs = self.cdb.smembers("Analytics:ByName:%s:Subscriptions" % a_name)
         for sub in subs:
             self.cdb.sadd("Subscriptions:%s:ActiveAnalytics" % sub, a_name)
+            if analytics["transport"] == "queue":
+                self.cdb.sadd("Subscriptions:%s:QueuedAnalytics" % sub,
+                              a_name)
+            if analytics["workers"] > 1:
+                self.cdb.hset("Subscriptions:%s:Shards" % sub, a_name,
+                              analytics["workers"])
+                self.cdb.hset("Subscriptions:%s:Partitions" % sub, a_name,
+                              partition_spec(analytics))
+        self.cdb.incr("Analytics:ByName:%s:Version" % a_name)
         self.cdb.publish("AnalyticsWorkerCmd", "refresh")
 
+    def get_data_db(self, analytics):
+        if analytics["data_db"]:
+            return get_data_db(analytics["data_db"], app=self.app)
+        return get_data_db(app=self.app)
+
+    def index_analytics(self, a_name):
+        """
+        Rebuilds the RefCount index of an analytics by rolling its daily
+        RefCount hashes up into buckets. Workers only maintain the index
+        for the transactions they write, so this is needed when an index is
+        added to an analytics that already has data. Disable the analytics
+        while it runs. Only keys of its slice and qnos dimensions are read
+        and replaced, which another analytics sharing the data db only has
+        if it writes the very same RefCounts.
+        """
+        analytics = Analytics(self.cdb.get("Analytics:ByName:%s" % a_name))
+        index = refcount_index(analytics)
+        if index is None:
+            sys.stderr.write("Analytics '%s' has no 'refcount_index'\n" %
+                             a_name)
+            return
+        dimension, parse_bucket = index
+        data_db = self.get_data_db(analytics)
+        # Analytics sharing the data db have keys of other dimensions
+        refcount_re = refcount_key_re(analytics, "RefCount", dimension)
+        index_re = refcount_key_re(analytics, "RefCountIndex", dimension)
+        first_dimension = sorted(analytics["slice_dimensions"])[0]
+
+        pipe = data_db.pipeline(transaction=False)
+        for key in data_db.scan_iter("RefCountIndex:%s*" % first_dimension,
+                                     count=1000):
+            if index_re.match(key):
+                pipe.delete(key)
+        pipe.execute()
+
+        buckets = {}
+        keys = [key for key in data_db.scan_iter(
+                "RefCount:%s*" % first_dimension, count=1000)
+                if refcount_re.match(key)]
+        for i in xrange(0, len(keys), 1000):
+            pipe = data_db.pipeline(transaction=False)
+            for key in keys[i:i + 1000]:
+                pipe.hgetall(key)
+            for key, ref_counts in zip(keys[i:i + 1000], pipe.execute()):
+                day = refcount_re.match(key)
+                index_key = "RefCountIndex%s%s%s" % (
+                    key[len("RefCount"):day.start(1)],
+                    parse_bucket(day.group(1)),
+                    key[day.end(1):])
+                bucket = buckets.setdefault(index_key, {})
+                for value, count in ref_counts.iteritems():
+                    bucket[value] = bucket.get(value, 0) + int(count)
+
+        pipe = data_db.pipeline(transaction=False)
+        for i, (index_key, bucket) in enumerate(buckets.iteritems()):
+            for value, count in bucket.iteritems():
+                if count:
+                    pipe.hset(index_key, value, count)
+            if i % 1000 == 999:
+                pipe.execute()
+        pipe.execute()
+
+    def rollup_analytics(self, a_name):
+        """
+        Rebuilds the rolled up measures of an analytics from its daily
+        keys. Workers only roll up the transactions they write, so this is
+        needed when rollups are added to an analytics that already has
+        data. Disable the analytics while it runs. Only keys of its
+        dimensions are read and replaced, which another analytics sharing
+        the data db only has if it writes the very same measure keys.
+        """
+        analytics = Analytics(self.cdb.get("Analytics:ByName:%s" % a_name))
+        rollup = rollups(analytics)
+        if rollup is None:
+            sys.stderr.write("Analytics '%s' has no 'rollups'\n" % a_name)
+            return
+        if analytics["storage"] == "hash":
+            sys.stderr.write("Rolled up measures of analytics '%s' can only "
+                             "be rebuilt with 'storage' 'keys'\n" % a_name)
+            return
+        dimension, buckets = rollup
+        data_db = self.get_data_db(analytics)
+
+        for measure in analytics["measures"]:
+            m_type = analytics["mapping"][measure]["type"]
+            # Analytics sharing the data db have keys of other dimensions
+            key_re = measure_key_re(analytics, measure, dimension)
+            keys = []
+            pipe = data_db.pipeline(transaction=False)
+            for key in data_db.scan_iter("%s:*" % measure, count=1000):
+                match = key_re.match(key)
+                if match is None:
+                    continue
+                if match.group(2):
+                    pipe.delete(key)
+                else:
+                    keys.append(key)
+            pipe.execute()
+
+            # Daily keys of every bucket key
+            bucket_keys = {}
+            for key in keys:
+                day = key_re.match(key)
+                for label, parse_bucket in buckets:
+                    bucket_key = "%s%s:%s%s" % (
+                        key[:day.start(1)], label,
+                        parse_bucket(day.group(3)), key[day.end(3):])
+                    bucket_keys.setdefault(bucket_key, []).append(key)
+
+            pipe = data_db.pipeline(transaction=False)
+            for i, (bucket_key, day_keys) in \
+                    enumerate(bucket_keys.iteritems()):
+                if m_type == "unique":
+                    pipe.sunionstore(bucket_key, day_keys)
+                elif m_type == "unique_approx":
+                    pipe.pfmerge(bucket_key, *day_keys)
+                else:
+                    values = [value for value in data_db.mget(day_keys)
+                              if value is not None]
+                    if m_type[-5:] == "float":
+                        pipe.set(bucket_key, repr(sum(map(float, values))))
+                    else:
+                        pipe.set(bucket_key, sum(map(int, values)))
+                if i % 1000 == 999:
+                    pipe.execute()
+            pipe.execute()
+
     def display_usage(self):
         sys.stdout.write("""
         Usage: %s <command> [<arg>[...]]
@@ -61,6 +308,8 @@ class AnalyticsManager:
         dumpall - Dumps all analytics. No args is required.
         disable - Disables one or more analytics given by name.
         enable - Enables one or more analytics given by name.
+        index - Rebuilds the RefCount index of analytics given by name.
+        rollup - Rebuilds the rolled up measures of analytics given by name.
         commands - Display this
         help - Display this\n""" % sys.argv[0])
 
@@ -92,6 +341,12 @@ if __name__ == "__main__":
         elif command == "enable":
             for a_name in args:
                 amgr.enable_analytics(a_name)
+        elif command == "index":
+            for a_name in args:
+                amgr.index_analytics(a_name)
+        elif command == "rollup":
+            for a_name in args:
+                amgr.rollup_analytics(a_name)
         elif command == "commands" or command == "help":
             amgr.display_usage()
         else:
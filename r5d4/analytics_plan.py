@@ -0,0 +1,256 @@
+from __future__ import absolute_import
+import zlib
+from r5d4.mapping_functions import MEASURING_FUNCTIONS_MAP,\
+    DIMENSION_PARSERS_MAP, DATE_DIMENSION_TYPES
+from r5d4.key_builder import KeyBuilder, rollup_dimension
+from r5d4.hash_storage import HashLayout, HashCounters
+
+
+def compile_conditions(conditions):
+    """
+    Compiles the conditions of a measure into a predicate on transactions.
+    Returns None when there are no conditions.
+
+    >>> compile_conditions([]) is None
+    True
+
+    >>> walkin = compile_conditions([{"field": "kind", "equals": "walkin"},
+    ...                              {"field": "doctor", "not_equals": 1}])
+    >>> walkin({"kind": "walkin", "doctor": 2})
+    True
+
+    >>> walkin({"kind": "walkin", "doctor": 1})
+    False
+
+    >>> walkin({"kind": "booked", "doctor": 2})
+    False
+    """
+    checks = []
+    for condition in conditions:
+        equals = condition.get("equals", None)
+        not_equals = condition.get("not_equals", None)
+        if equals is not None:
+            checks.append((condition["field"], True, equals))
+        elif not_equals is not None:
+            checks.append((condition["field"], False, not_equals))
+    if not checks:
+        return None
+    checks = tuple(checks)
+
+    def predicate(transaction):
+        for field, expected, value in checks:
+            if (transaction[field] == value) != expected:
+                return False
+        return True
+    return predicate
+
+
+def shard_of(value, shards):
+    """
+    Returns the shard, out of shards, owning a dimension value.
+    Stable across processes and runs, unlike hash().
+
+    >>> shard_of(u"north", 4) == shard_of("north", 4)
+    True
+
+    >>> sorted(set(shard_of(i, 3) for i in range(100)))
+    [0, 1, 2]
+    """
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return (zlib.crc32(str(value)) & 0xffffffff) % shards
+
+
+def partition(analytics):
+    """
+    Returns (field, parser) of the partition dimension of an analytics, or
+    None when it isn't sharded
+    """
+    d = analytics["partition_by"]
+    if not d or (analytics["workers"] or 1) == 1:
+        return None
+    mapping = analytics["mapping"]
+    return mapping[d]["field"], DIMENSION_PARSERS_MAP[mapping[d]["type"]]
+
+
+def owner_of(transaction, partition, shards):
+    """
+    Returns the shard, out of shards, writing transaction, partition being
+    (field, parser) of the partition dimension
+
+    >>> partition = ("practice", int)
+    >>> owner_of({"practice": "7"}, partition, 3) == shard_of(7, 3)
+    True
+    """
+    field, parser = partition
+    return shard_of(parser(transaction[field]), shards)
+
+
+def daily_dimension(analytics):
+    """
+    Returns the slice dimension of type 'date' of an analytics, or None
+    """
+    mapping = analytics["mapping"]
+    for d in analytics["slice_dimensions"]:
+        if mapping[d]["type"] == "date":
+            return d
+    return None
+
+
+def refcount_index(analytics):
+    """
+    Returns (dimension, parse_bucket) for an analytics with a
+    'refcount_index': its daily slice dimension and the parser giving the
+    bucket of a day. Returns None otherwise.
+    """
+    if not analytics["refcount_index"]:
+        return None
+    return (daily_dimension(analytics),
+            DIMENSION_PARSERS_MAP[analytics["refcount_index"]])
+
+
+def rollups(analytics):
+    """
+    Returns (dimension, ((label, parse_bucket), ...)) for an analytics with
+    'rollups': its daily slice dimension and, coarsest bucket first, the
+    name the keys of a bucket are written under with the parser giving the
+    bucket of a day. Returns None otherwise.
+    """
+    if not analytics["rollups"]:
+        return None
+    d = daily_dimension(analytics)
+    return d, tuple(
+        (rollup_dimension(d, bucket), DIMENSION_PARSERS_MAP[bucket])
+        for bucket in reversed(DATE_DIMENSION_TYPES)
+        if bucket in analytics["rollups"])
+
+
+def hash_layout(analytics):
+    """
+    Returns the HashLayout of an analytics with 'storage': 'hash', or None
+    """
+    if analytics["storage"] != "hash":
+        return None
+    return HashLayout(daily_dimension(analytics))
+
+
+class AnalyticsPlan:
+    """
+    Execution plan of an Analytics for the worker.
+    Everything that doesn't depend on the transaction is derived once:
+    dimensions are pre-sorted and bound to their parsers, measures are
+    grouped by resource channel with their measuring functions and
+    compiled conditions. The plan is not modified after construction.
+    """
+    def __init__(self, analytics):
+        mapping = analytics["mapping"]
+        query_dimensions = set(analytics["query_dimensions"])
+        slice_dimensions = set(analytics["slice_dimensions"])
+
+        # (dimension, field, parser) for every dimension used in keys
+        self.dimensions = tuple(
+            (d, mapping[d]["field"], DIMENSION_PARSERS_MAP[mapping[d]["type"]])
+            for d in sorted(query_dimensions | slice_dimensions)
+        )
+        self.keys = KeyBuilder(query_dimensions, slice_dimensions)
+        # RefCounts are also summed per bucket of days when indexed
+        self.refcount_index = refcount_index(analytics)
+        # Measures are also written per bucket of days when rolled up
+        self.rollups = rollups(analytics)
+        # Counters are written in hash fields with the hash storage
+        self.layout = hash_layout(analytics)
+        # (dimension, field) for RefCount updates
+        self.qnos_dimensions = tuple(
+            (d, mapping[d]["field"])
+            for d in sorted(query_dimensions - slice_dimensions)
+        )
+
+        # channel -> ((measure, function, field, predicate), ...)
+        measures_by_channel = {}
+        for m in analytics["measures"]:
+            measures_by_channel.setdefault(mapping[m]["resource"], []).append((
+                m,
+                MEASURING_FUNCTIONS_MAP[mapping[m]["type"]],
+                mapping[m].get("field", None),
+                compile_conditions(mapping[m].get("conditions", []))
+            ))
+        self.measures_by_channel = dict(
+            (channel, tuple(measures))
+            for channel, measures in measures_by_channel.iteritems()
+        )
+
+        # Transactions are spread over the shards of a sharded analytics by
+        # the value of its partition dimension
+        self.shards = analytics["workers"] or 1
+        self.partition = partition(analytics)
+
+    def owner(self, transaction):
+        """
+        Returns the shard writing the keys of transaction
+        """
+        if self.partition is None:
+            return 0
+        return owner_of(transaction, self.partition, self.shards)
+
+    def owns(self, shard, transaction):
+        """
+        Tells whether shard is the one writing the keys of transaction
+        """
+        return self.owner(transaction) == shard
+
+    def apply(self, pipe, channel, tr_type, transaction):
+        """
+        Queues on pipe the writes for a transaction received on channel.
+        Returns the (RefCount key, field) pairs decremented by it.
+        """
+        values = {}
+        for dimension, field, parser in self.dimensions:
+            values[dimension] = parser(transaction[field])
+
+        query_key_str, slice_key_str, snoq_key_str = \
+            self.keys.transaction_keys(values)
+
+        ref_count_slices = [(self.keys.refcount_key, slice_key_str)]
+        if self.refcount_index is not None and self.qnos_dimensions:
+            d, parse_bucket = self.refcount_index
+            bucket_values = dict(values)
+            bucket_values[d] = parse_bucket(values[d])
+            ref_count_slices.append((self.keys.refcount_index_key,
+                                     self.keys.slice_key(bucket_values)))
+
+        # Updating Reference count for qnos dimensions
+        ref_counts = []
+        for dimension, field in self.qnos_dimensions:
+            for refcount_key, key_str in ref_count_slices:
+                ref_count_key = refcount_key(key_str, dimension)
+                if tr_type == "insert":
+                    pipe.hincrby(ref_count_key, transaction[field], 1)
+                elif tr_type == "delete":
+                    pipe.hincrby(ref_count_key, transaction[field], -1)
+                    ref_counts.append((ref_count_key, transaction[field]))
+
+        snoq_key_strs = [snoq_key_str]
+        if self.rollups is not None:
+            d, buckets = self.rollups
+            bucket_values = dict(values)
+            for label, parse_bucket in buckets:
+                bucket_values[d] = parse_bucket(values[d])
+                snoq_key_strs.append(self.keys.snoq_key(bucket_values, d,
+                                                        label))
+
+        counters = pipe
+        if self.layout is not None:
+            counters = HashCounters(pipe, self.layout)
+        for measure, function, field, predicate in \
+                self.measures_by_channel.get(channel, ()):
+            if predicate is not None and not predicate(transaction):
+                continue
+            for snoq_key_str in snoq_key_strs:
+                kwargs = {
+                    "key_str": self.keys.measure_key(measure, query_key_str,
+                                                     snoq_key_str),
+                }
+                if field is not None:
+                    kwargs["field_val"] = transaction[field]
+                function(counters, tr_type, **kwargs)
+        return ref_counts
@@ -1,119 +1,390 @@
 #!/usr/bin/env python
 from __future__ import absolute_import
 import sys
+import time
 import traceback
 from flask import json
 import signal
 from multiprocessing import Process
 from r5d4.analytics import Analytics
-from r5d4.mapping_functions import MEASURING_FUNCTIONS_MAP,\
-    DIMENSION_PARSERS_MAP
-from r5d4.flask_redis import get_conf_db, get_data_db
+from r5d4.analytics_plan import shard_of
+from r5d4.flask_redis import get_conf_db, get_data_db, \
+    supports_incrbyfloat
 from r5d4.utility import construct_key
+from r5d4.write_buffer import WriteBuffer
+from r5d4.transport import PubSubTransport, QueueTransport, \
+    rebalance_queues
 from r5d4.logger import get_worker_log
 from r5d4 import app
 
+# Channel of the commands to the master, workers reload on 'refresh'
+COMMAND_CHANNEL = 'AnalyticsWorkerCmd'
 
-def actual_worker(analytics_name, sub, app):
-    log = get_worker_log(analytics_name)
-    try:
-        conf_db = get_conf_db(app, exclusive=True)
-        defn = conf_db.get("Analytics:ByName:%s" % analytics_name)
+
+def is_refresh(batch):
+    return batch[0]["channel"] == COMMAND_CHANNEL and \
+        batch[0]["data"].lower() == "refresh"
+
+
+def worker_layout(analytics):
+    """
+    Returns what decides how the workers of an analytics are laid out
+    """
+    return (analytics["workers"] or 1, analytics["partition_by"],
+            analytics["transport"] or "pubsub")
+
+
+def is_dispatched(analytics, app):
+    """
+    Tells whether an analytics is run by a dispatcher rather than by
+    worker processes of its own
+    """
+    return app.config["WORKER_DISPATCHERS"] > 0 and \
+        worker_layout(analytics)[::2] == (1, "pubsub")
+
+
+def dispatcher_of(a_name, app):
+    return shard_of(a_name, app.config["WORKER_DISPATCHERS"])
+
+
+def decode_message(content):
+    """
+    Returns (channel, tr_type, transaction) of a received message
+    """
+    data = json.loads(content["data"])
+    return (data.get("channel", content["channel"]), data["tr_type"],
+            data["payload"])
+
+
+class AnalyticsRunner:
+    """
+    Writes decoded transactions to the data db of an analytics through its
+    compiled plan. Used by the worker processes of the analytics and by
+    dispatchers alike.
+    """
+    def __init__(self, analytics_name, app, shard=0):
+        if shard:
+            self.log = get_worker_log("%s:%d" % (analytics_name, shard))
+        else:
+            self.log = get_worker_log(analytics_name)
+        self.analytics_name = analytics_name
+        self.app = app
+        self.shard = shard
+        self.conf_db = get_conf_db(app, exclusive=True)
+        self.version_key = "Analytics:ByName:%s:Version" % analytics_name
+        self.reload_interval = app.config["WORKER_RELOAD_INTERVAL"]
+        self.next_reload_check = time.time() + self.reload_interval
+        self.load()
+
+    def load(self, layout=None):
+        """
+        Reads and compiles the current definition. Nothing is replaced
+        unless all of it succeeds and, when given, the worker layout is
+        still layout. Returns True if the definition was replaced.
+        """
+        pipe = self.conf_db.pipeline()
+        pipe.get("Analytics:ByName:%s" % self.analytics_name)
+        pipe.get(self.version_key)
+        defn, version = pipe.execute()
         analytics = Analytics(defn)
+        if layout is not None and worker_layout(analytics) != layout:
+            return False
         if analytics["data_db"]:
-            data_db = get_data_db(analytics["data_db"], app=app)
+            data_db = get_data_db(analytics["data_db"], app=self.app)
         else:
-            data_db = get_data_db(app=app)
-        measures = set(analytics["measures"])
-        query_dimensions = set(analytics["query_dimensions"])
-        slice_dimensions = set(analytics["slice_dimensions"])
-        mapping = analytics["mapping"]
-        for content in sub.listen():
-            if content["type"] == "message":
+            data_db = get_data_db(app=self.app)
+        plan = analytics.compile()
+        native_float = supports_incrbyfloat(data_db)
+        if not native_float:
+            self.log.warn("Redis server has no INCRBYFLOAT, float measures "
+                          "will use WATCH transactions")
+        generation_key = None
+        if analytics["invalidate_cache"]:
+            # Browsers drop cached results when the generation changes
+            generation_key = construct_key("Generation", self.analytics_name)
+
+        self.analytics = analytics
+        self.data_db = data_db
+        self.plan = plan
+        self.native_float = native_float
+        self.generation_key = generation_key
+        self.version = version
+        return True
+
+    def reload(self, force=False):
+        """
+        Swaps in the current definition if its version changed since it was
+        loaded, checking at most every WORKER_RELOAD_INTERVAL seconds unless
+        forced. Changes to the worker layout are left to the master, which
+        replaces the workers. Returns True if the definition was swapped.
+        """
+        now = time.time()
+        if now < self.next_reload_check and not force:
+            return False
+        self.next_reload_check = now + self.reload_interval
+        if self.conf_db.get(self.version_key) == self.version:
+            return False
+        try:
+            if not self.load(worker_layout(self.analytics)):
+                return False
+        except (ValueError, AssertionError) as e:
+            self.log.error("Keeping the loaded definition, the new one is "
+                           "invalid: %s" % str(e))
+            self.version = self.conf_db.get(self.version_key)
+            return False
+        self.log.info("Reloaded definition version %s" % self.version)
+        return True
+
+    def write(self, transactions):
+        """
+        Writes a batch of (channel, tr_type, transaction) in one pipeline.
+        Transactions that can't be consumed are logged and skipped, errors
+        while writing are raised.
+        """
+        for channel, tr_type, transaction in transactions:
+            if channel not in self.plan.measures_by_channel:
+                # Subscribed for a definition that isn't loaded yet
+                self.reload(force=True)
+                break
+
+        # Writes of the whole batch are coalesced and sent together
+        batch_buffer = WriteBuffer()
+        ref_counts = set()
+        for channel, tr_type, transaction in transactions:
+            try:
+                # Every shard receives the transaction, one writes it
+                if not self.plan.owns(self.shard, transaction):
+                    continue
+                # Writes of a transaction are merged only if it succeeds
+                pipe = WriteBuffer()
+                ref_counts.update(self.plan.apply(pipe, channel, tr_type,
+                                                  transaction))
+                batch_buffer.update(pipe)
+            except Exception:
+                self.log.error("Error while consuming transaction.\n%s" %
+                               traceback.format_exc())
+                self.log.debug("Resource was: %s" % channel)
+                self.log.debug("Transaction was: %s" % json.dumps(
+                    {"tr_type": tr_type, "payload": transaction}))
+
+        if self.generation_key is not None and len(batch_buffer) > 0:
+            batch_buffer.incr(self.generation_key)
+        values = batch_buffer.execute(self.data_db, self.native_float)
+        for command, key, error in batch_buffer.errors:
+            self.log.error("Redis refused %s on '%s': %s" % (
+                command.upper(), key, error))
+
+        # Removing qnos values whose reference count dropped to 0
+        zero_ref_counts = [ref_count for ref_count in ref_counts
+                           if values.get(ref_count) == 0]
+        if zero_ref_counts:
+            pipe = self.data_db.pipeline()
+            for ref_count_key, qnos_value in zero_ref_counts:
+                pipe.hdel(ref_count_key, qnos_value)
+            pipe.execute()
+
+    def route(self, batch):
+        """
+        Splits a batch read from the queue of this shard into the messages
+        it writes, with their decoded transactions, and (shard, message)
+        of those another shard writes, queued while the analytics had
+        another number of shards
+        """
+        owned = []
+        transactions = []
+        foreign = []
+        for content in batch:
+            transaction = decode_content(content, self.log)
+            if transaction is not None:
                 try:
-                    data = json.loads(content["data"])
-                    transaction = data["payload"]
-                    tr_type = data["tr_type"]
-
-                    snoq_dimensions = slice_dimensions - query_dimensions
-                    qnos_dimensions = query_dimensions - slice_dimensions
-
-                    def build_key_str(dimensions):
-                        key = []
-                        for dimension in sorted(list(dimensions)):
-                            d_type = mapping[dimension]["type"]
-                            function = DIMENSION_PARSERS_MAP[d_type]
-                            field = mapping[dimension]["field"]
-                            key.append(dimension)
-                            key.append(function(transaction[field]))
-                        return construct_key(key)
-
-                    query_key_str = build_key_str(query_dimensions)
-                    slice_key_str = build_key_str(slice_dimensions)
-                    snoq_key_str = build_key_str(snoq_dimensions)
-
-                    # Updating Reference count for qnos dimensions
-                    for dimension in sorted(list(qnos_dimensions)):
-                        field = mapping[dimension]["field"]
-                        ref_count_key = construct_key('RefCount',
-                                                      slice_key_str,
-                                                      dimension)
-                        if tr_type == "insert":
-                            value = data_db.hincrby(ref_count_key,
-                                                    transaction[field],
-                                                    1)
-                        elif tr_type == "delete":
-                            value = data_db.hincrby(ref_count_key,
-                                                    transaction[field],
-                                                    -1)
-                            if value == 0:
-                                data_db.hdel(ref_count_key, transaction[field])
-
-                    # Each measure gets added one at a time
-                    for m in measures:
-                        if mapping[m]["resource"] != content["channel"]:
-                            continue
-                        key_str = construct_key(m, query_key_str, snoq_key_str)
-                        function = MEASURING_FUNCTIONS_MAP[mapping[m]["type"]]
-                        field = mapping[m].get("field", None)
-                        conditions = mapping[m].get("conditions", [])
-                        kwargs = {
-                            "key_str": key_str,
-                        }
-
-                        for condition in conditions:
-                            condition_field = condition["field"]
-                            equals = condition.get("equals", None)
-                            not_equals = condition.get("not_equals", None)
-                            if equals is not None:
-                                if transaction[condition_field] != equals:
-                                    break  # Failed equals condition
-                            elif not_equals is not None:
-                                if transaction[condition_field] == not_equals:
-                                    break  # Failed not equals condition
-                        else:
-                            # All conditions passed
-                            if field is not None:
-                                kwargs["field_val"] = transaction[field]
-                            function(data_db, tr_type, **kwargs)
+                    shard = self.plan.owner(transaction[2])
+                except Exception:
+                    # Written here, where the error is logged
+                    shard = self.shard
+                if shard != self.shard:
+                    foreign.append((shard, content))
+                    continue
+                transactions.append(transaction)
+            owned.append(content)
+        return owned, transactions, foreign
 
-                except Exception, e:
-                    log.error("Error while consuming transaction.\n%s" %
-                              traceback.format_exc())
-                    log.debug("Resource was: %s" % content["channel"])
-                    log.debug("Data was: %s" % json.dumps(data))
+
+def decode_content(content, log):
+    """
+    Returns the decoded transaction of a message, or None after logging
+    why it can't be decoded
+    """
+    try:
+        return decode_message(content)
+    except Exception:
+        log.error("Error while decoding transaction.\n%s" %
+                  traceback.format_exc())
+        log.debug("Resource was: %s" % content["channel"])
+        log.debug("Data was: %s" % content["data"])
+        return None
+
+
+def decode_batch(batch, log):
+    transactions = []
+    for content in batch:
+        transaction = decode_content(content, log)
+        if transaction is not None:
+            transactions.append(transaction)
+    return transactions
+
+
+def actual_worker(analytics_name, sub, app, shard=0):
+    runner = None
+    try:
+        runner = AnalyticsRunner(analytics_name, app, shard)
+        batch_size, batch_timeout = batch_options([runner])
+        if runner.analytics["transport"] == "queue":
+            transport = QueueTransport(runner.conf_db, analytics_name,
+                                       batch_size, shard)
+        else:
+            transport = PubSubTransport(sub, batch_size, batch_timeout,
+                                        COMMAND_CHANNEL)
+        for batch in transport.batches():
+            command = batch[0]["channel"] == COMMAND_CHANNEL
+            if runner.reload(force=is_refresh(batch)):
+                # Batching changes apply from the next batch
+                transport.batch_size, transport.batch_timeout = \
+                    batch_options([runner])
+            if command:
+                continue
+            try:
+                if runner.analytics["transport"] == "queue":
+                    batch, transactions, foreign = runner.route(batch)
+                    if foreign:
+                        transport.forward(foreign)
+                else:
+                    transactions = decode_batch(batch, runner.log)
+                runner.write(transactions)
+                transport.ack(batch)
+            except Exception, e:
+                runner.log.error("Error while writing %d transactions.\n%s" %
+                                 (len(batch), traceback.format_exc()))
+                transport.fail(batch)
     except Exception, e:
+        log = runner.log if runner is not None else \
+            get_worker_log(analytics_name)
         log.critical("Worker crashed.\nError was: %s" % str(e))
         log.debug("Traceback: %s" % traceback.format_exc())
         signal.pause()
 
 
+def batch_options(runners):
+    """
+    Returns the batch size and timeout of a transport shared by runners,
+    the most lenient of the options of their analytics
+    """
+    return (max(runner.analytics["batch_size"] or 1 for runner in runners),
+            max(runner.analytics["batch_timeout"] or 0 for runner in runners))
+
+
+def route_by_channel(runners):
+    runners_by_channel = {}
+    for runner in runners:
+        for channel in runner.plan.measures_by_channel:
+            runners_by_channel.setdefault(channel, []).append(runner)
+    return runners_by_channel
+
+
+def dispatched_analytics(conf_db, app, dispatcher):
+    """
+    Returns the names of the active analytics run by dispatcher
+    """
+    a_names = []
+    for a_name in conf_db.smembers('Analytics:Active'):
+        analytics = Analytics(conf_db.get("Analytics:ByName:%s" % a_name))
+        if is_dispatched(analytics, app) and \
+                dispatcher_of(a_name, app) == dispatcher:
+            a_names.append(a_name)
+    return sorted(a_names)
+
+
+def regroup(runners, a_names, app, log):
+    """
+    Returns the runners of a_names, keeping those already in runners and
+    creating the others. Analytics whose definition can't be loaded are
+    left out.
+    """
+    by_name = dict((runner.analytics_name, runner) for runner in runners)
+    regrouped = []
+    for a_name in a_names:
+        if a_name not in by_name:
+            try:
+                by_name[a_name] = AnalyticsRunner(a_name, app)
+            except (ValueError, AssertionError) as e:
+                log.error("Not dispatching %s, its definition is invalid: "
+                          "%s" % (a_name, str(e)))
+                continue
+            log.info("Dispatching %s" % a_name)
+        regrouped.append(by_name[a_name])
+    for a_name in set(by_name) - set(a_names):
+        log.info("No longer dispatching %s" % a_name)
+    return regrouped
+
+
+def dispatcher_worker(a_names, sub, app, dispatcher=0):
+    """
+    Worker for a group of analytics sharing one subscription. Each message
+    is received and decoded once, then handed to the runner of every
+    analytics measuring its resource.
+    The master subscribes sub to the channels of analytics joining the
+    group, after the refresh on which the dispatcher adds their runners.
+    """
+    log = get_worker_log("dispatcher:%d" % dispatcher)
+    try:
+        conf_db = get_conf_db(app, exclusive=True)
+        runners = [AnalyticsRunner(a_name, app) for a_name in a_names]
+        runners_by_channel = route_by_channel(runners)
+        batch_size, batch_timeout = batch_options(runners)
+        transport = PubSubTransport(sub, batch_size, batch_timeout,
+                                    COMMAND_CHANNEL)
+        for batch in transport.batches():
+            force = is_refresh(batch)
+            changed = [runner for runner in runners if runner.reload(force)]
+            if force:
+                regrouped = regroup(
+                    runners, dispatched_analytics(conf_db, app, dispatcher),
+                    app, log)
+                changed = changed or regrouped != runners
+                runners = regrouped
+            if changed:
+                runners_by_channel = route_by_channel(runners)
+            if changed and runners:
+                transport.batch_size, transport.batch_timeout = \
+                    batch_options(runners)
+            if batch[0]["channel"] == COMMAND_CHANNEL:
+                continue
+            routed = {}
+            for transaction in decode_batch(batch, log):
+                for runner in runners_by_channel.get(transaction[0], ()):
+                    routed.setdefault(runner, []).append(transaction)
+            for runner, transactions in routed.iteritems():
+                try:
+                    runner.write(transactions)
+                except Exception, e:
+                    runner.log.error(
+                        "Error while writing %d transactions.\n%s" % (
+                            len(transactions), traceback.format_exc()))
+    except Exception, e:
+        log.critical("Dispatcher crashed.\nError was: %s" % str(e))
+        log.debug("Traceback: %s" % traceback.format_exc())
+        signal.pause()
+
+
 class AnalyticsWorker():
     def __init__(self, app):
         self.app = app
         self.conf_db = get_conf_db(app, exclusive=True)
+        self.analytics = {}
+        # Keyed by (analytics name, shard)
         self.proc = {}
         self.subs = {}
+        # Dispatcher number -> (process, sub, {analytics name: channels})
+        self.dispatchers = {}
         self.log = get_worker_log('master')
 
         signal.signal(signal.SIGTERM, self.termination_handler)
@@ -121,39 +392,140 @@ class AnalyticsWorker():
         signal.signal(signal.SIGCHLD, self.child_handler)
 
     def create_worker(self, a_name):
-        sub = self.conf_db.pubsub()
-        sub.subscribe(self.conf_db.smembers(
-            "Analytics:ByName:%s:Subscriptions" % a_name
-        ))
-        self.subs[a_name] = sub
+        analytics = Analytics(self.conf_db.get("Analytics:ByName:%s" % a_name))
+        self.analytics[a_name] = analytics
+        if is_dispatched(analytics, self.app):
+            # Picked up by update_dispatchers
+            return
+        for shard in xrange(analytics["workers"] or 1):
+            self.create_shard(a_name, shard)
 
+    def create_shard(self, a_name, shard):
+        if self.analytics[a_name]["transport"] == "queue":
+            # Worker reads its own queue, nothing to subscribe
+            sub = None
+        else:
+            sub = self.conf_db.pubsub()
+            sub.subscribe(self.conf_db.smembers(
+                "Analytics:ByName:%s:Subscriptions" % a_name
+            ) | set([COMMAND_CHANNEL]))
+        self.subs[(a_name, shard)] = sub
+
+        if shard:
+            self.log.info("Creating worker %d for %s" % (shard, a_name))
+        else:
+            self.log.info("Creating worker for %s" % a_name)
+        self.proc[(a_name, shard)] = self.spawn(
+            actual_worker, (a_name, sub, self.app, shard))
+
+    def spawn(self, target, args):
         prev_chld_handler = signal.signal(signal.SIGCHLD, signal.SIG_DFL)
         prev_term_handler = signal.signal(signal.SIGTERM, signal.SIG_DFL)
         prev_int_handler = signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-        self.log.info("Creating worker for %s" % a_name)
-        p = Process(target=actual_worker, args=(a_name, sub, self.app))
+        p = Process(target=target, args=args)
         p.start()
 
         signal.signal(signal.SIGTERM, prev_term_handler)
         signal.signal(signal.SIGINT, prev_int_handler)
         signal.signal(signal.SIGCHLD, prev_chld_handler)
-
-        self.proc[a_name] = p
+        return p
 
     def destroy_worker(self, a_name):
         self.log.info("%s is getting deleted" % a_name)
+        analytics = self.analytics.pop(a_name)
+        if is_dispatched(analytics, self.app):
+            return
+        for shard in xrange(analytics["workers"] or 1):
+            self.destroy_shard(a_name, shard)
+
+    def destroy_shard(self, a_name, shard):
+        prev_chld_handler = signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        p = self.proc.pop((a_name, shard))
+        p.terminate()
+        p.join()
+        sub = self.subs.pop((a_name, shard))
+        if sub is not None:
+            sub.unsubscribe()
+        signal.signal(signal.SIGCHLD, prev_chld_handler)
+
+    def create_dispatcher(self, dispatcher, group):
+        sub = self.conf_db.pubsub()
+        sub.subscribe(set([COMMAND_CHANNEL]).union(*group.values()))
+        self.log.info("Creating dispatcher %d for %s" % (
+            dispatcher, ", ".join(sorted(group))))
+        p = self.spawn(dispatcher_worker,
+                       (sorted(group), sub, self.app, dispatcher))
+        self.dispatchers[dispatcher] = (p, sub, group)
+
+    def destroy_dispatcher(self, dispatcher):
         prev_chld_handler = signal.signal(signal.SIGCHLD, signal.SIG_IGN)
-        p = self.proc[a_name]
-        del self.proc[a_name]
+        p, sub, group = self.dispatchers.pop(dispatcher)
         p.terminate()
         p.join()
-        self.subs[a_name].unsubscribe()
-        del self.subs[a_name]
+        sub.unsubscribe()
         signal.signal(signal.SIGCHLD, prev_chld_handler)
 
+    def update_dispatcher(self, dispatcher, group):
+        """
+        Subscribes a running dispatcher to the channels of its new group
+        and unsubscribes it from the others. The dispatcher swaps its
+        runners itself on the refresh that brought the change.
+        """
+        p, sub, old_group = self.dispatchers[dispatcher]
+        # sub.channels is only updated by the reads of the dispatcher
+        old_subs = set([COMMAND_CHANNEL]).union(*old_group.values())
+        new_subs = set([COMMAND_CHANNEL]).union(*group.values())
+        self.log.info("Updating dispatcher %d for %s" % (
+            dispatcher, ", ".join(sorted(group))))
+        add_sub = new_subs - old_subs
+        if add_sub:
+            sub.subscribe(add_sub)
+        rem_sub = old_subs - new_subs
+        if rem_sub:
+            sub.unsubscribe(rem_sub)
+        self.dispatchers[dispatcher] = (p, sub, group)
+
+    def update_dispatchers(self):
+        """
+        Starts, updates or stops the dispatchers whose analytics or channels
+        changed
+        """
+        groups = {}
+        for a_name, analytics in self.analytics.iteritems():
+            if is_dispatched(analytics, self.app):
+                groups.setdefault(dispatcher_of(a_name, self.app), {})[
+                    a_name] = self.conf_db.smembers(
+                        "Analytics:ByName:%s:Subscriptions" % a_name)
+        for dispatcher in set(self.dispatchers.keys()) | set(groups.keys()):
+            group = groups.get(dispatcher)
+            if dispatcher not in self.dispatchers:
+                self.create_dispatcher(dispatcher, group)
+            elif not group:
+                self.destroy_dispatcher(dispatcher)
+            elif self.dispatchers[dispatcher][2] != group:
+                self.update_dispatcher(dispatcher, group)
+
+    def requeue(self, a_name, old_analytics, analytics):
+        """
+        Hands the transactions the stopped workers of old_analytics left
+        on the queues of removed shards to the workers of analytics
+        """
+        if analytics["transport"] == "queue":
+            new_shards = analytics["workers"] or 1
+        else:
+            new_shards = 0
+        moved = rebalance_queues(self.conf_db, a_name,
+                                 old_analytics["workers"] or 1, new_shards)
+        if moved and not new_shards:
+            self.log.warn("Dropped %d transactions queued for %s, it no "
+                          "longer uses a queue" % (len(moved), a_name))
+        elif moved:
+            self.log.info("Requeued %d transactions for %s" % (
+                len(moved), a_name))
+
     def update_analytics(self):
-        old_a_name = set(self.subs.keys())
+        old_a_name = set(self.analytics.keys())
         new_a_name = set(self.conf_db.smembers('Analytics:Active'))
 
         add_a_name = new_a_name - old_a_name
@@ -165,25 +537,50 @@ class AnalyticsWorker():
             self.destroy_worker(a_name)
 
         for a_name in old_a_name & new_a_name:
-            old_subs = self.subs[a_name].channels
+            analytics = Analytics(
+                self.conf_db.get("Analytics:ByName:%s" % a_name))
+            if worker_layout(analytics) != \
+                    worker_layout(self.analytics[a_name]):
+                # Shards own keys by partition, all of them are replaced
+                self.log.info("Rebalancing %s over %d workers" % (
+                    a_name, analytics["workers"] or 1))
+                old_analytics = self.analytics[a_name]
+                self.destroy_worker(a_name)
+                if old_analytics["transport"] == "queue":
+                    self.requeue(a_name, old_analytics, analytics)
+                self.create_worker(a_name)
+                continue
+            # Workers reload other changes of the definition themselves
+            self.analytics[a_name] = analytics
+            if analytics["transport"] == "queue" or \
+                    is_dispatched(analytics, self.app):
+                continue
             new_subs = self.conf_db.smembers(
                 "Analytics:ByName:%s:Subscriptions" % a_name
             )
-            add_sub = new_subs - old_subs
-            for s in add_sub:
-                self.subs[a_name].subscribe(s)
-            rem_sub = old_subs - new_subs
-            for s in rem_sub:
-                self.subs[a_name].unsubscribe(s)
-                if self.subs[a_name].subscription_count == 0:
-                    self.destroy_worker(a_name)
+            if not new_subs:
+                self.destroy_worker(a_name)
+                continue
+            new_subs.add(COMMAND_CHANNEL)
+            for shard in xrange(analytics["workers"] or 1):
+                sub = self.subs[(a_name, shard)]
+                # A dictionary of channels to handlers in newer redis-py
+                old_subs = set(sub.channels)
+                add_sub = new_subs - old_subs
+                for s in add_sub:
+                    sub.subscribe(s)
+                rem_sub = old_subs - new_subs
+                for s in rem_sub:
+                    sub.unsubscribe(s)
+        self.update_dispatchers()
 
     def start(self):
         for a_name in self.conf_db.smembers('Analytics:Active'):
             self.create_worker(a_name)
-        self.log.info("Listening on 'AnalyticsWorkerCmd' channel")
+        self.update_dispatchers()
+        self.log.info("Listening on '%s' channel" % COMMAND_CHANNEL)
         commands = self.conf_db.pubsub()
-        commands.subscribe('AnalyticsWorkerCmd')
+        commands.subscribe(COMMAND_CHANNEL)
         for cmd in commands.listen():
             if cmd['type'] == 'message':
                 self.log.debug('Received %s', cmd['data'])
@@ -195,19 +592,29 @@ class AnalyticsWorker():
         signal.signal(signal.SIGCHLD, signal.SIG_DFL)
         signal.signal(signal.SIGTERM, signal.SIG_DFL)
         signal.signal(signal.SIGINT, signal.SIG_DFL)
-        for p in self.proc.values():
+        for p in self.proc.values() + \
+                [p for p, sub, group in self.dispatchers.values()]:
             if p.is_alive():
                 p.terminate()
             p.join()
 
     def child_handler(self, sig_val, ret_code):
-        for a_name in self.proc.keys():
-            if not self.proc[a_name].is_alive():
+        for a_name, shard in self.proc.keys():
+            if not self.proc[(a_name, shard)].is_alive():
                 self.log.warn(
-                    "Worker Process for %s is not alive, respawning" % a_name
+                    "Worker Process %d for %s is not alive, respawning" % (
+                        shard, a_name)
                 )
-                self.destroy_worker(a_name)
-                self.create_worker(a_name)
+                self.destroy_shard(a_name, shard)
+                self.create_shard(a_name, shard)
+        for dispatcher in self.dispatchers.keys():
+            p, sub, group = self.dispatchers[dispatcher]
+            if not p.is_alive():
+                self.log.warn(
+                    "Dispatcher %d is not alive, respawning" % dispatcher
+                )
+                self.destroy_dispatcher(dispatcher)
+                self.create_dispatcher(dispatcher, group)
 
     def termination_handler(self, sig_val, ret_code):
         self.log.info("Analytics Worker is shutting down")
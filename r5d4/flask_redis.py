@@ -1,7 +1,35 @@
+import os
 from flask import current_app
 import redis
 
 
+# Connection pools of this process keyed by (transport, address, db) and
+# the transport that worked for each (unix_socket_path, host, port)
+connection_pools = {}
+working_transports = {}
+pools_pid = None
+
+
+def get_connection_pool(transport, address, db):
+    global pools_pid
+    if pools_pid != os.getpid():
+        # Pools inherited from the parent process hold its sockets
+        connection_pools.clear()
+        pools_pid = os.getpid()
+    if (transport, address, db) not in connection_pools:
+        if transport == "unix":
+            pool = redis.ConnectionPool(
+                connection_class=redis.UnixDomainSocketConnection,
+                path=address,
+                db=db
+            )
+        else:
+            host, port = address
+            pool = redis.ConnectionPool(host=host, port=port, db=db)
+        connection_pools[(transport, address, db)] = pool
+    return connection_pools[(transport, address, db)]
+
+
 def connect_redis(unix_socket_path, host, port, db):
     """
     >>> from r5d4.test_settings import (REDIS_UNIX_SOCKET_PATH,
@@ -23,31 +51,28 @@ def connect_redis(unix_socket_path, host, port, db):
     False
     """
 
-    # Try connecting through UNIX socket
-    settings = {
-        "unix_socket_path": unix_socket_path,
-        "db": db
-    }
-    try:
-        r = redis.Redis(**settings)
-        r.ping()
-        return r
-    except redis.exceptions.ConnectionError:
-        pass
-
-    # Fallback, try TCP connection
-    settings = {
-        "host": host,
-        "port": port,
-        "db": db
-    }
-    try:
-        r = redis.Redis(**settings)
-        r.ping()
+    server = (unix_socket_path, host, port)
+    if server in working_transports:
+        transport, address = working_transports[server]
+        return redis.Redis(
+            connection_pool=get_connection_pool(transport, address, db))
+
+    # Try connecting through UNIX socket, fallback to TCP connection
+    for transport, address in [("unix", unix_socket_path),
+                               ("tcp", (host, port))]:
+        pool = get_connection_pool(transport, address, db)
+        r = redis.Redis(connection_pool=pool)
+        try:
+            r.ping()
+        except redis.exceptions.ConnectionError:
+            pool.disconnect()
+            # Another thread or greenlet may have dropped it already
+            connection_pools.pop((transport, address, db), None)
+            continue
+        working_transports[server] = (transport, address)
         return r
-    except redis.exceptions.ConnectionError:
-        # No more fallbacks
-        return None
+    # No more fallbacks
+    return None
 
 
 def get_conf_db(app=current_app, exclusive=False):
@@ -74,3 +99,18 @@ def get_data_db(data_db=None, app=current_app):
         port=app.config["REDIS_PORT"],
         db=data_db
     )
+
+
+def server_version(conn):
+    """
+    Returns the version of the Redis server behind conn as a tuple of ints
+    """
+    version = conn.info()["redis_version"].split("-")[0]
+    return tuple(map(int, version.split(".")))
+
+
+def supports_incrbyfloat(conn):
+    """
+    INCRBYFLOAT and HINCRBYFLOAT are available from Redis 2.6 onwards
+    """
+    return server_version(conn) >= (2, 6)
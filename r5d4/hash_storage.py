@@ -0,0 +1,74 @@
+from __future__ import absolute_import
+import re
+
+
+class HashLayout:
+    """
+    Where the counters of an analytics with 'storage': 'hash' are kept.
+    A counter key holds a day of the daily dimension, or the first day of
+    one of its rollup buckets. The counters of a month are fields of one
+    hash: its key has the month instead of the day, the field is the day.
+    A month has at most 31 fields, so Redis keeps its hash in the compact
+    ziplist/listpack encoding.
+
+    >>> layout = HashLayout("date")
+    >>> layout.locate("visits:date:20111005:practice:1")
+    ('visits:date:201110:practice:1', '20111005')
+
+    >>> layout.locate("visits:practice:1:date/week:20111003")
+    ('visits:practice:1:date/week:201110', '20111003')
+
+    >>> layout.locate("visits:practice:1")
+    Traceback (most recent call last):
+        ...
+    ValueError: ('No date in counter key', 'visits:practice:1')
+    """
+    def __init__(self, dimension):
+        self.day_re = re.compile(r"(?:^|:)%s(?:/[a-z]+)?:\d{6}(\d{2})(?=:|$)"
+                                 % re.escape(dimension))
+
+    def locate(self, key):
+        """
+        Returns the (hash key, field) of a counter key
+        """
+        match = self.day_re.search(key)
+        if match is None:
+            raise ValueError("No date in counter key", key)
+        return (key[:match.start(1)] + key[match.end(1):],
+                key[match.start(1) - 6:match.end(1)])
+
+
+class HashCounters:
+    """
+    Handed to the measuring functions in place of pipe for an analytics
+    stored in hashes: counters are incremented in their hash field, other
+    writes go to pipe unchanged.
+
+    >>> from r5d4.write_buffer import WriteBuffer
+    >>> buf = WriteBuffer()
+    >>> counters = HashCounters(buf, HashLayout("date"))
+    >>> counters.incr("visits:date:20111005", 2)
+    >>> counters.decr("visits:date:20111005")
+    >>> buf.hash_counters
+    {('visits:date:201110', '20111005'): 1}
+    """
+    def __init__(self, pipe, layout):
+        self.pipe = pipe
+        self.layout = layout
+
+    def incr(self, name, amount=1):
+        hash_key, field = self.layout.locate(name)
+        self.pipe.hincrby(hash_key, field, amount)
+
+    def decr(self, name, amount=1):
+        self.incr(name, -amount)
+
+    def incrbyfloat(self, name, amount=1.0):
+        hash_key, field = self.layout.locate(name)
+        self.pipe.hincrbyfloat(hash_key, field, amount)
+
+    def sadd(self, name, *values):
+        self.pipe.sadd(name, *values)
+
+    def pfadd(self, name, *values):
+        self.pipe.pfadd(name, *values)
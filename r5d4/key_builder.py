@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+
+
+def key_fragment(dimension, value):
+    """
+    Part of a key for one dimension value, written as construct_key would
+
+    >>> key_fragment("practice", 1)
+    'practice:1'
+
+    >>> key_fragment("clinic", "")
+    'clinic'
+
+    >>> key_fragment("clinic", None)
+    'clinic'
+    """
+    if value is None:
+        return dimension
+    value = str(value)
+    if value == '':
+        return dimension
+    return dimension + ':' + value
+
+
+def rollup_dimension(dimension, bucket):
+    """
+    Name the buckets of a daily dimension are written under in keys
+
+    >>> rollup_dimension("date", "month")
+    'date/month'
+    """
+    return dimension + '/' + bucket
+
+
+def join_key(*parts):
+    """
+    Joins key parts that are already strings, skipping empty ones as
+    construct_key does
+
+    >>> join_key("visits", "date:20110101", "")
+    'visits:date:20110101'
+    """
+    return ':'.join([part for part in parts if part])
+
+
+class KeyBuilder:
+    """
+    Builds the data keys of an analytics in the format of construct_key.
+    Dimension names are sorted once, and the values of a transaction are
+    stringified once whichever keys they appear in. Every key is then a
+    single join over parts that are already strings.
+
+    >>> keys = KeyBuilder(["date", "practice"], ["date", "clinic"])
+    >>> parts = keys.transaction_keys(
+    ...     {"date": "20110101", "practice": 1, "clinic": "north"})
+    >>> parts
+    ('date:20110101:practice:1', 'clinic:north:date:20110101', \
+'clinic:north')
+
+    >>> query_key_str, slice_key_str, snoq_key_str = parts
+    >>> keys.measure_key("visits", query_key_str, snoq_key_str)
+    'visits:date:20110101:practice:1:clinic:north'
+
+    >>> keys.refcount_key(slice_key_str, "practice")
+    'RefCount:clinic:north:date:20110101:practice'
+
+    >>> keys.refcount_index_key(keys.slice_key(
+    ...     {"date": "20110101", "clinic": "north"}), "practice")
+    'RefCountIndex:clinic:north:date:20110101:practice'
+
+    >>> keys.snoq_key({"clinic": "north"}, "clinic", "region")
+    'region:north'
+    """
+    def __init__(self, query_dimensions, slice_dimensions):
+        query_dimensions = set(query_dimensions)
+        slice_dimensions = set(slice_dimensions)
+        self.dimensions = tuple(sorted(query_dimensions | slice_dimensions))
+        self.query_dimensions = tuple(sorted(query_dimensions))
+        self.slice_dimensions = tuple(sorted(slice_dimensions))
+        self.snoq_dimensions = tuple(sorted(slice_dimensions -
+                                            query_dimensions))
+
+    def transaction_keys(self, values):
+        """
+        Returns the query, slice and snoq key strings of a transaction,
+        values holding its parsed value for every dimension
+        """
+        fragments = {}
+        for dimension in self.dimensions:
+            fragments[dimension] = key_fragment(dimension, values[dimension])
+        return tuple(':'.join([fragments[d] for d in dimensions])
+                     for dimensions in (self.query_dimensions,
+                                        self.slice_dimensions,
+                                        self.snoq_dimensions))
+
+    def slice_key(self, values):
+        return ':'.join([key_fragment(d, values[d])
+                         for d in self.slice_dimensions])
+
+    def snoq_key(self, values, dimension, label):
+        """
+        snoq key str where dimension is written under label
+        """
+        return ':'.join([key_fragment(label if d == dimension else d,
+                                      values[d])
+                         for d in self.snoq_dimensions])
+
+    def measure_key(self, measure, query_key_str, snoq_key_str):
+        return join_key(measure, query_key_str, snoq_key_str)
+
+    def refcount_key(self, slice_key_str, dimension):
+        return join_key('RefCount', slice_key_str, dimension)
+
+    def refcount_index_key(self, slice_key_str, dimension):
+        return join_key('RefCountIndex', slice_key_str, dimension)
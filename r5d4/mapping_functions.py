@@ -1,79 +1,123 @@
 from __future__ import absolute_import
+import re
 from dateutil.parser import parse
-from datetime import timedelta
+from datetime import datetime, timedelta
 from r5d4.utility import (date_iterator, week_iterator, month_iterator,
-                          year_iterator)
+                          year_iterator, LRUCache)
 
 
 # Measuring functions
+# Each measuring function queues its writes on the pipeline it is given,
+# the worker executes the pipeline once per batch. Measures are write-only:
+# nothing is read back while writing, values such as cardinalities are
+# computed by the browser.
 
-def score(conn, tr_type, **kwargs):
+def integer_amount(value):
+    """
+    Returns a score as the integer INCRBY takes, raising ValueError for
+    values Redis would refuse. Writes of a batch are coalesced, so a bad
+    value has to be caught with the transaction carrying it.
+
+    >>> integer_amount(3), integer_amount("-3")
+    (3, -3)
+
+    >>> integer_amount(2.5)
+    Traceback (most recent call last):
+        ...
+    ValueError: Score '2.5' is not an integer
+    """
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, basestring) and re.match(r"^-?\d+$", value):
+        return int(value)
+    raise ValueError("Score '%s' is not an integer" % value)
+
+
+def float_amount(value):
+    """
+    Returns a score as the float INCRBYFLOAT takes, raising ValueError for
+    values Redis would refuse
+
+    >>> float_amount(2.5), float_amount("3")
+    (2.5, 3.0)
+
+    >>> float_amount("inf")
+    Traceback (most recent call last):
+        ...
+    ValueError: Score 'inf' is not a finite number
+    """
+    if isinstance(value, bool):
+        raise ValueError("Score '%s' is not a number" % value)
+    amount = float(value)
+    if amount != amount or amount in (float("inf"), float("-inf")):
+        raise ValueError("Score '%s' is not a finite number" % value)
+    return amount
+
+
+def score(pipe, tr_type, **kwargs):
     key_str = kwargs["key_str"]
-    field_val = kwargs["field_val"]
+    field_val = integer_amount(kwargs["field_val"])
 
     if tr_type.lower() == "insert":
-        return conn.incr(key_str, field_val)
+        pipe.incr(key_str, field_val)
     elif tr_type.lower() == "delete":
-        return conn.decr(key_str, field_val)
+        pipe.decr(key_str, field_val)
     else:
         raise ValueError("Unknown transaction type", tr_type)
 
 
-def score_float(conn, tr_type, **kwargs):
+def score_float(pipe, tr_type, **kwargs):
     key_str = kwargs["key_str"]
-    field_val = kwargs["field_val"]
+    field_val = float_amount(kwargs["field_val"])
 
     if tr_type.lower() == "insert":
-        def incrbyfloat(pipe):
-            current_value = pipe.get(key_str)
-            if current_value is None:
-                current_value = 0.0
-            new_value = float(current_value) + field_val
-            pipe.multi()
-            pipe.set(key_str, new_value)
-        return conn.transaction(incrbyfloat, key_str)
+        pipe.incrbyfloat(key_str, field_val)
     elif tr_type.lower() == "delete":
-        def decrbyfloat(pipe):
-            current_value = pipe.get(key_str)
-            if current_value is None:
-                current_value = 0.0
-            new_value = float(current_value) - field_val
-            pipe.multi()
-            pipe.set(key_str, new_value)
-        return conn.transaction(decrbyfloat, key_str)
+        pipe.incrbyfloat(key_str, -field_val)
     else:
         raise ValueError("Unknown transaction type", tr_type)
 
 
-def count(conn, tr_type, **kwargs):
+def count(pipe, tr_type, **kwargs):
     kwargs["field_val"] = 1
-    return score(conn, tr_type, **kwargs)
+    score(pipe, tr_type, **kwargs)
 
 
-def count_float(conn, tr_type, **kwargs):
+def count_float(pipe, tr_type, **kwargs):
     kwargs["field_val"] = 1.0
-    return score_float(conn, tr_type, **kwargs)
+    score_float(pipe, tr_type, **kwargs)
+
+
+def heat(pipe, tr_type, **kwargs):
+    count(pipe, "insert", **kwargs)
 
 
-def heat(conn, tr_type, **kwargs):
-    return count(conn, "insert", **kwargs)
+def heat_float(pipe, tr_type, **kwargs):
+    count_float(pipe, "insert", **kwargs)
 
 
-def heat_float(conn, tr_type, **kwargs):
-    return count_float(conn, "insert", **kwargs)
+def unique(pipe, tr_type, **kwargs):
+    key_str = kwargs["key_str"]
+    field_val = kwargs["field_val"]
+    pipe.sadd(key_str, field_val)
 
 
-def unique(conn, tr_type, **kwargs):
+def unique_approx(pipe, tr_type, **kwargs):
+    """
+    Estimated count of distinct values, in a HyperLogLog of at most 12kB
+    per key. Values can't be removed from it, deletes add them too like
+    they do for unique.
+    """
     key_str = kwargs["key_str"]
     field_val = kwargs["field_val"]
-    conn.sadd(key_str, field_val)
-    return conn.scard(key_str)
+    pipe.pfadd(key_str, field_val)
 
 MEASURING_FUNCTIONS_MAP = {
     "heat": heat,
     "count": count,
     "score": score,
     "unique": unique,
+    "unique_approx": unique_approx,
     "heat_float": heat_float,
     "count_float": count_float,
     "score_float": score_float
@@ -128,6 +172,98 @@ def fmt_date(date):
     return date.strftime("%Y%m%d")
 
 
+# Fast path for the common formats: YYYY-MM-DD, YYYY-MM-DD HH:MM:SS and
+# YYYYMMDD. Anything else goes through dateutil.
+ISO_DATE_RE = re.compile(
+    r"([1-9][0-9]{3})-([0-9]{2})-([0-9]{2})"
+    r"(?: ([0-9]{2}):([0-9]{2}):([0-9]{2}))?$")
+COMPACT_DATE_RE = re.compile(r"([1-9][0-9]{3})([0-9]{2})([0-9]{2})$")
+
+# Bucket values of recently parsed dates, keyed by the date part of the
+# input on the fast path and by the raw input otherwise
+DATE_BUCKET_CACHE_SIZE = 4096
+date_bucket_cache = LRUCache(DATE_BUCKET_CACHE_SIZE)
+
+
+def match_date(date_str):
+    """
+    Returns (year, month, day) strings if date_str is in one of the fast
+    path formats, None otherwise.
+
+    >>> match_date("2011-02-01 10:02:00")
+    ('2011', '02', '01')
+
+    >>> match_date("20111021")
+    ('2011', '10', '21')
+
+    >>> match_date("21-Sep-2011") is None
+    True
+
+    >>> match_date("2011-02-01 24:00:00")
+    Traceback (most recent call last):
+        ...
+    ValueError: ('Invalid date', '2011-02-01 24:00:00')
+    """
+    if not isinstance(date_str, basestring):
+        return None
+    match = ISO_DATE_RE.match(date_str)
+    if match is not None:
+        year, month, day, hour, minute, second = match.groups()
+        if hour is not None and \
+                (int(hour) > 23 or int(minute) > 59 or int(second) > 59):
+            raise ValueError("Invalid date", date_str)
+        return year, month, day
+    match = COMPACT_DATE_RE.match(date_str)
+    if match is not None:
+        return match.groups()
+    return None
+
+
+def parse_date_bucket(date_str, bucket):
+    """
+    Parses date_str and returns bucket(date), a formatted date string
+    """
+    if date_str is None or date_str == "":
+        raise ValueError('Invalid date', date_str)
+    ymd = match_date(date_str)
+    if ymd is not None:
+        cache_key = (bucket, ymd)
+    else:
+        cache_key = (bucket, date_str)
+    try:
+        return date_bucket_cache[cache_key]
+    except KeyError:
+        pass
+    except TypeError:  # Unhashable input, can't be a date anyway
+        return bucket(parse_date_to_obj(date_str))
+    if ymd is not None:
+        try:
+            date_obj = datetime(*map(int, ymd))
+        except ValueError:
+            raise ValueError("Invalid date", date_str)
+    else:
+        date_obj = parse_date_to_obj(date_str)
+    value = bucket(date_obj)
+    date_bucket_cache[cache_key] = value
+    return value
+
+
+def date_bucket(date_obj):
+    return fmt_date(date_obj)
+
+
+def week_bucket(date_obj):
+    return fmt_date(date_obj - timedelta(days=date_obj.weekday()))
+
+
+def month_bucket(date_obj):
+    return fmt_date(date_obj.replace(day=1))
+
+
+def year_bucket(date_obj):
+    return fmt_date(date_obj.replace(day=1, month=1))
+
+
 def parse_date(date_str):
     """
     Extract date part from given input string
@@ -161,9 +297,7 @@ def parse_date(date_str):
     ValueError: ('Invalid date', '')
 
     """
-    if date_str is None or date_str == "":
-        raise ValueError('Invalid date', date_str)
-    return fmt_date(parse_date_to_obj(date_str))
+    return parse_date_bucket(date_str, date_bucket)
 
 
 def parse_week(date_str):
@@ -174,10 +308,7 @@ def parse_week(date_str):
     >>> parse_week('19/9/2011')
     '20110919'
     """
-    if date_str is None or date_str == "":
-        raise ValueError('Invalid date', date_str)
-    date_obj = parse_date_to_obj(date_str)
-    return fmt_date(date_obj - timedelta(days=date_obj.weekday()))
+    return parse_date_bucket(date_str, week_bucket)
 
 
 def parse_month(date_str):
@@ -196,9 +327,7 @@ def parse_month(date_str):
     >>> parse_month('23/2/2011')
     '20110201'
     """
-    if date_str is None or date_str == "":
-        raise ValueError('Invalid date', date_str)
-    return fmt_date(parse_date_to_obj(date_str).replace(day=1))
+    return parse_date_bucket(date_str, month_bucket)
 
 
 def parse_year(date_str):
@@ -212,9 +341,7 @@ def parse_year(date_str):
     >>> parse_year('Wed Sep 21 10:27:58 UTC 2011')
     '20110101'
     """
-    if date_str is None or date_str == "":
-        raise ValueError('Invalid date', date_str)
-    return fmt_date(parse_date_to_obj(date_str).replace(day=1, month=1))
+    return parse_date_bucket(date_str, year_bucket)
 
 
 DIMENSION_PARSERS_MAP = {
@@ -226,6 +353,8 @@ DIMENSION_PARSERS_MAP = {
     "year": parse_year
 }
 
+DATE_DIMENSION_TYPES = ["date", "week", "month", "year"]
+
 
 RANGE_OPERATOR = '..'
 
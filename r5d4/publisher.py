@@ -1,24 +1,178 @@
 from __future__ import absolute_import
+from flask import json, current_app
 from werkzeug.exceptions import ServiceUnavailable, NotFound
+from r5d4.analytics_plan import shard_of, owner_of
+from r5d4.mapping_functions import DIMENSION_PARSERS_MAP
 from r5d4.flask_redis import get_conf_db
+from r5d4.transport import queue_key
 
+TRANSACTION_TYPES = ["insert", "delete"]
 
-def publish_transaction(channel, tr_type, payload):
-    conf_db = get_conf_db()
-    if tr_type not in ["insert", "delete"]:
-        raise ValueError("Unknown transaction type", tr_type)
-    subscribed = conf_db.scard("Subscriptions:%s:ActiveAnalytics" % channel)
-    if subscribed == 0:
+
+def transaction_message(channel, tr_type, payload):
+    return '{' \
+        '  "channel" : ' + json.dumps(channel) + ', ' \
+        '  "tr_type" : "' + tr_type + '", ' \
+        '  "payload" : ' + payload + \
+        '}'
+
+
+def parse_transactions(body):
+    """
+    Parses a JSON array or NDJSON stream of {"tr_type", "payload"} objects
+    into (tr_type, payload) pairs, payload being JSON text.
+
+    >>> parse_transactions('[{"tr_type": "insert", "payload": {"a": 1}}]')
+    [(u'insert', '{"a": 1}')]
+
+    >>> parse_transactions('{"tr_type": "insert", "payload": {"a": 1}}\\n'
+    ...                    '\\n'
+    ...                    '{"tr_type": "delete", "payload": "{}"}')
+    [(u'insert', '{"a": 1}'), (u'delete', u'{}')]
+
+    >>> parse_transactions('[{"payload": {}}]')
+    Traceback (most recent call last):
+        ...
+    ValueError: ('Transaction 0 is missing', 'tr_type')
+
+    >>> parse_transactions('')
+    Traceback (most recent call last):
+        ...
+    ValueError: No transactions in the request body
+    """
+    if body.lstrip().startswith('['):
+        items = json.loads(body)
+    else:
+        items = [json.loads(line) for line in body.splitlines()
+                 if line.strip()]
+    transactions = []
+    for i, item in enumerate(items):
+        for key in ["tr_type", "payload"]:
+            if not isinstance(item, dict) or key not in item:
+                raise ValueError("Transaction %d is missing" % i, key)
+        payload = item["payload"]
+        if not isinstance(payload, basestring):
+            payload = json.dumps(payload)
+        transactions.append((item["tr_type"], payload))
+    if not transactions:
+        raise ValueError("No transactions in the request body")
+    return transactions
+
+
+def get_subscriptions(conf_db, channel):
+    """
+    Returns the number of workers subscribed to channel and the analytics
+    taking it through queues, as (name, shards, partition) with partition
+    the (field, parser) transactions are routed by when shards > 1. Every
+    shard of a sharded pubsub analytics is a worker, analytics run by a
+    dispatcher count once per dispatcher, queued analytics count once.
+    """
+    pipe = conf_db.pipeline(transaction=False)
+    pipe.smembers("Subscriptions:%s:ActiveAnalytics" % channel)
+    pipe.smembers("Subscriptions:%s:QueuedAnalytics" % channel)
+    pipe.hgetall("Subscriptions:%s:Shards" % channel)
+    pipe.hgetall("Subscriptions:%s:Partitions" % channel)
+    active, queued, shards, partitions = pipe.execute()
+    if len(active) == 0:
         raise NotFound(("Channel not found",
                         "Channel '%(channel)s' is not found or has 0 "
                         "subscriptions" % locals()))
-    listened = conf_db.publish(
-        channel,
-        '{'
-        '  "tr_type" : "' + tr_type + '", '
-        '  "payload" : ' + payload +
-        '}'
-    )
+    dispatchers = current_app.config["WORKER_DISPATCHERS"]
+    subscribed = 0
+    queues = []
+    dispatched = set()
+    for a_name in sorted(active):
+        workers = int(shards.get(a_name, 1))
+        if a_name in queued:
+            partition = None
+            if workers > 1:
+                field, d_type = json.loads(partitions[a_name])
+                partition = (field, DIMENSION_PARSERS_MAP[d_type])
+            queues.append((a_name, workers, partition))
+        elif dispatchers > 0 and workers == 1:
+            dispatched.add(shard_of(a_name, dispatchers))
+        else:
+            subscribed += workers
+    subscribed += len(dispatched) + len(queues)
+    return subscribed, queues
+
+
+def check_backlog(conf_db, queues):
+    """
+    Refuses new transactions while a queue holds QUEUE_MAX_LENGTH or more
+    """
+    max_length = current_app.config["QUEUE_MAX_LENGTH"]
+    if not queues or not max_length:
+        return
+    keys = [queue_key(a_name, shard)
+            for a_name, shards, partition in queues
+            for shard in xrange(shards)]
+    pipe = conf_db.pipeline(transaction=False)
+    for key in keys:
+        pipe.llen(key)
+    for key, length in zip(keys, pipe.execute()):
+        if length >= max_length:
+            raise ServiceUnavailable((
+                "Queue full",
+                "%s has %d pending transactions" % (key, length)
+            ))
+
+
+def queue_shard(payload, partition, shards):
+    """
+    Returns the shard whose queue gets a transaction, the one writing it.
+    Transactions without a valid partition value go to the first shard,
+    which logs them.
+
+    >>> queue_shard('{"practice": 7}', ("practice", int), 3) == shard_of(7, 3)
+    True
+
+    >>> queue_shard('{}', ("practice", int), 3)
+    0
+    """
+    try:
+        return owner_of(json.loads(payload), partition, shards)
+    except Exception:
+        return 0
+
+
+def publish_messages(conf_db, channel, transactions):
+    """
+    Delivers (tr_type, payload) transactions to every worker subscribed to
+    channel through one pipeline, with PUBLISH for pubsub workers and LPUSH
+    on a queue of the others: the queue of the shard writing it for sharded
+    analytics. Returns the subscribed count and the listened count of each
+    transaction.
+    """
+    subscribed, queues = get_subscriptions(conf_db, channel)
+    check_backlog(conf_db, queues)
+    publish = subscribed > len(queues)
+    pipe = conf_db.pipeline(transaction=False)
+    for tr_type, payload in transactions:
+        message = transaction_message(channel, tr_type, payload)
+        if publish:
+            pipe.publish(channel, message)
+        for a_name, shards, partition in queues:
+            shard = 0
+            if partition is not None:
+                shard = queue_shard(payload, partition, shards)
+            pipe.lpush(queue_key(a_name, shard), message)
+    results = pipe.execute()
+    if publish:
+        step = 1 + len(queues)
+        listened = [published + len(queues)
+                    for published in results[::step]]
+    else:
+        listened = [len(queues)] * len(transactions)
+    return subscribed, listened
+
+
+def publish_transaction(channel, tr_type, payload):
+    conf_db = get_conf_db()
+    if tr_type not in TRANSACTION_TYPES:
+        raise ValueError("Unknown transaction type", tr_type)
+    subscribed, [listened] = publish_messages(
+        conf_db, channel, [(tr_type, payload)])
     if listened != subscribed:
         raise ServiceUnavailable((
             "Subscription-Listened mismatch",
@@ -27,3 +181,29 @@ def publish_transaction(channel, tr_type, payload):
                 subscribed
             )
         ))
+
+
+def publish_transactions(channel, transactions):
+    """
+    Publishes (tr_type, payload) pairs on channel through one pipeline.
+    Returns the listened count of each transaction.
+    """
+    conf_db = get_conf_db()
+    for tr_type, payload in transactions:
+        if tr_type not in TRANSACTION_TYPES:
+            raise ValueError("Unknown transaction type", tr_type)
+    subscribed, listened = publish_messages(conf_db, channel, transactions)
+    mismatched = [i for i, count in enumerate(listened)
+                  if count != subscribed]
+    if mismatched:
+        raise ServiceUnavailable((
+            "Subscription-Listened mismatch",
+            "Listened count doesn't match Subscribed count = %d for %d of "
+            "%d transactions, first at %d" % (
+                subscribed,
+                len(mismatched),
+                len(listened),
+                mismatched[0]
+            )
+        ))
+    return listened
@@ -0,0 +1,49 @@
+from __future__ import absolute_import
+import time
+from flask import current_app
+from r5d4.utility import LRUCache
+
+
+class QueryCache:
+    """
+    LRU cache of browse results where every entry has its own time to live
+    and, optionally, the generation of the analytics data it was computed
+    from.
+
+    >>> cache = QueryCache(10)
+    >>> cache.set("q", "result", ttl=60, generation="3")
+    >>> cache.get("q", generation="3")
+    'result'
+
+    >>> cache.get("q", generation="4") is None
+    True
+
+    >>> cache.get("q", generation="3") is None
+    True
+
+    >>> cache.set("q", "result", ttl=-1)
+    >>> cache.get("q") is None
+    True
+    """
+    def __init__(self, maxsize):
+        self.entries = LRUCache(maxsize)
+
+    def get(self, key, generation=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, entry_generation, value = entry
+        if expires_at < time.time() or entry_generation != generation:
+            del self.entries[key]
+            return None
+        return value
+
+    def set(self, key, value, ttl, generation=None):
+        if ttl > 0:
+            self.entries[key] = (time.time() + ttl, generation, value)
+
+
+def get_query_cache(app=current_app):
+    if not hasattr(app, 'query_cache'):
+        app.query_cache = QueryCache(app.config["QUERY_CACHE_SIZE"])
+    return app.query_cache
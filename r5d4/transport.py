@@ -0,0 +1,183 @@
+from __future__ import absolute_import
+import time
+
+# Seconds a blocking read waits before checking again
+BLOCK_TIMEOUT = 1
+
+
+class PubSubTransport:
+    """
+    Transactions published on the resource channels. Messages published
+    while no worker is listening are lost.
+    Messages on the commands channel, if given, close the current batch and
+    are yielded on their own, so they take effect between the transactions
+    published before and after them.
+    """
+    def __init__(self, sub, batch_size=1, batch_timeout=0, commands=None):
+        self.sub = sub
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.commands = commands
+
+    def batches(self):
+        """
+        Yields lists of messages received on sub. A batch is closed when it
+        has batch_size messages, or when batch_timeout milliseconds have
+        passed since its first message was received and no other message
+        is already waiting. Without a timeout, a batch takes the messages
+        already received without waiting for more.
+        """
+        for content in self.sub.listen():
+            if content["type"] != "message":
+                continue
+            if content["channel"] == self.commands:
+                yield [content]
+                continue
+            batch = [content]
+            command = None
+            deadline = time.time() + self.batch_timeout / 1000.0
+            while len(batch) < self.batch_size:
+                remaining = max(0, deadline - time.time())
+                content = self.sub.get_message(timeout=remaining)
+                if content is None:
+                    if remaining == 0:
+                        break
+                    continue
+                if content["type"] != "message":
+                    continue
+                if content["channel"] == self.commands:
+                    command = content
+                    break
+                batch.append(content)
+            yield batch
+            if command is not None:
+                yield [command]
+
+    def ack(self, batch):
+        pass
+
+    def fail(self, batch):
+        pass
+
+
+def queue_key(a_name, shard=0):
+    """
+    >>> queue_key("Visits")
+    'Queue:Visits'
+
+    >>> queue_key("Visits", 2)
+    'Queue:Visits:2'
+    """
+    if shard == 0:
+        return "Queue:%s" % a_name
+    return "Queue:%s:%d" % (a_name, shard)
+
+
+class QueueTransport:
+    """
+    Transactions pushed by the publisher on a list per analytics shard,
+    Queue:<name> for the first one and Queue:<name>:<shard> for the others.
+    A transaction is pushed on the queue of the shard writing it only.
+    Reads move transactions to <queue>:Processing where they stay until
+    acknowledged, so a worker that restarts first consumes whatever it
+    hadn't acknowledged, then carries on from where it was.
+    Delivery is at least once. Batches that couldn't be written are moved
+    to <queue>:Failed rather than replayed, as part of their writes may
+    have been applied.
+    """
+    def __init__(self, conn, a_name, batch_size=1, shard=0):
+        self.conn = conn
+        self.a_name = a_name
+        self.queue = queue_key(a_name, shard)
+        self.processing = "%s:Processing" % self.queue
+        self.failed = "%s:Failed" % self.queue
+        self.batch_size = batch_size
+
+    def message(self, data):
+        return {"type": "message", "channel": self.queue, "data": data}
+
+    def batches(self):
+        """
+        Yields lists of at most batch_size transactions. Blocks until one
+        is available, then takes whatever else is already queued in a
+        single pipeline.
+        """
+        # Transactions left unacknowledged by a previous worker, oldest first
+        pending = self.conn.lrange(self.processing, 0, -1)
+        pending.reverse()
+        for i in xrange(0, len(pending), self.batch_size):
+            yield map(self.message, pending[i:i + self.batch_size])
+
+        while True:
+            data = self.conn.brpoplpush(self.queue, self.processing,
+                                        BLOCK_TIMEOUT)
+            if data is None:
+                continue
+            batch = [self.message(data)]
+            if self.batch_size > 1:
+                pipe = self.conn.pipeline(transaction=False)
+                for i in xrange(self.batch_size - 1):
+                    pipe.rpoplpush(self.queue, self.processing)
+                batch.extend(self.message(data) for data in pipe.execute()
+                             if data is not None)
+            yield batch
+
+    def ack(self, batch):
+        pipe = self.conn.pipeline(transaction=False)
+        for content in batch:
+            # LREM argument order differs between redis-py's client classes
+            pipe.execute_command("LREM", self.processing, -1,
+                                 content["data"])
+        pipe.execute()
+
+    def fail(self, batch):
+        pipe = self.conn.pipeline()
+        for content in batch:
+            pipe.lpush(self.failed, content["data"])
+            pipe.execute_command("LREM", self.processing, -1,
+                                 content["data"])
+        pipe.execute()
+
+    def forward(self, routed):
+        """
+        Moves (shard, message) pairs to the queue of shard, for messages
+        queued while the analytics had another number of shards
+        """
+        pipe = self.conn.pipeline()
+        for shard, content in routed:
+            pipe.lpush(queue_key(self.a_name, shard), content["data"])
+            pipe.execute_command("LREM", self.processing, -1,
+                                 content["data"])
+        pipe.execute()
+
+
+def rebalance_queues(conn, a_name, old_shards, new_shards):
+    """
+    Moves the transactions queued for the shards of an analytics that no
+    longer exist, when its number of workers drops from old_shards to
+    new_shards, to the queue of the first shard. Workers forward whatever
+    they don't own to its shard, as they do for transactions routed under
+    the previous number of workers. Workers must be stopped meanwhile.
+    Returns the moved transactions, oldest first.
+    """
+    lists = []
+    for shard in xrange(new_shards, old_shards):
+        queue = queue_key(a_name, shard)
+        lists.extend([queue, "%s:Processing" % queue])
+    if not lists:
+        return []
+    # Lists are emptied at once, transactions pushed later stay queued
+    pipe = conn.pipeline()
+    for key in lists:
+        pipe.lrange(key, 0, -1)
+    pipe.delete(*lists)
+    contents = pipe.execute()[:-1]
+
+    moved = []
+    for i in xrange(0, len(contents), 2):
+        queued, processing = contents[i:i + 2]
+        moved.extend(processing[::-1] + queued[::-1])
+    if moved and new_shards:
+        # Consumed from the right, the oldest goes last
+        conn.rpush(queue_key(a_name, 0), *moved[::-1])
+    return moved
@@ -1,7 +1,14 @@
 from __future__ import absolute_import
+from collections import OrderedDict
+from itertools import islice
 from datetime import datetime, timedelta
 from dateutil.parser import parse
-from flask import jsonify
+from flask import json
+try:
+    from gevent.monkey import is_module_patched
+    from gevent.pool import Pool
+except ImportError:
+    is_module_patched = None
 
 
 def fmt_date(date):
@@ -90,10 +97,130 @@ def year_iterator(from_date, to_date):
             from_date = from_date.replace(year=from_date.year + 1)
 
 
-def json_response(f):
-    def new_f(*args, **kwargs):
-        return jsonify(f(*args, **kwargs))
-    return new_f
+def iter_json(document, key):
+    """
+    Serializes a dictionary whose document[key] is an iterator of lists
+    into chunks of JSON text, one per list, document[key] being serialized
+    as a single JSON array
+
+    >>> "".join(iter_json({"status": "OK", "data": iter([[1, 2], [3]])},
+    ...                   "data"))
+    '{"status": "OK", "data": [1, 2, 3]}'
+    """
+    members = ['%s: %s, ' % (json.dumps(other_key), json.dumps(value))
+               for other_key, value in sorted(document.iteritems())
+               if other_key != key]
+    yield '{%s%s: [' % ("".join(members), json.dumps(key))
+    separator = ''
+    for items in document[key]:
+        if items:
+            yield separator + json.dumps(items)[1:-1]
+            separator = ', '
+    yield ']}'
+
+
+def iter_ndjson(batches):
+    """
+    Serializes an iterator of lists into chunks of NDJSON text, one per list
+
+    >>> list(iter_ndjson([[{"a": 1}, {"a": 2}], [{"a": 3}]]))
+    ['{"a": 1}\\n{"a": 2}\\n', '{"a": 3}\\n']
+    """
+    # One encoder for the whole stream, json.dumps sets one up every call
+    encode = json.JSONEncoder(sort_keys=True).encode
+    for items in batches:
+        yield "".join(encode(item) + "\n" for item in items)
+
+
+def chunks(items, size):
+    """
+    Splits a list or an iterator into consecutive lists of at most size
+    items
+
+    >>> list(chunks([1, 2, 3, 4, 5], 2))
+    [[1, 2], [3, 4], [5]]
+
+    >>> list(chunks(iter("abc"), 2))
+    [['a', 'b'], ['c']]
+
+    >>> list(chunks([], 2))
+    []
+    """
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def concurrent_map(function, items, size):
+    """
+    map() that runs the calls concurrently in at most size greenlets when
+    sockets are patched by gevent, as under run_gevent.py, and one after
+    the other otherwise. Results are in the order of items.
+
+    >>> concurrent_map(len, ["a", "bc", ""], 2)
+    [1, 2, 0]
+    """
+    items = list(items)
+    if len(items) > 1 and size > 1 and is_module_patched is not None and \
+            is_module_patched("socket"):
+        # Each greenlet holds a pooled Redis connection while it runs
+        return Pool(size).map(function, items)
+    return map(function, items)
+
+
+class LRUCache:
+    """
+    Dictionary-like cache holding at most maxsize items. Once full, the
+    least recently used item is evicted.
+
+    >>> cache = LRUCache(2)
+    >>> cache["a"] = 1
+    >>> cache["b"] = 2
+    >>> cache["a"]
+    1
+    >>> cache["c"] = 3
+    >>> "b" in cache, "a" in cache, "c" in cache
+    (False, True, True)
+    >>> len(cache)
+    2
+    >>> cache.get("b", 0)
+    0
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def __getitem__(self, key):
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def __delitem__(self, key):
+        del self.items[key]
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self.items.clear()
 
 
 def construct_key(*args):
@@ -0,0 +1,170 @@
+from __future__ import absolute_import
+
+
+def watch_incrbyfloat(conn, name, amount):
+    """
+    Optimistic float increment for servers without INCRBYFLOAT
+    """
+    def incrbyfloat(pipe):
+        current_value = pipe.get(name)
+        if current_value is None:
+            current_value = 0.0
+        new_value = float(current_value) + amount
+        pipe.multi()
+        pipe.set(name, new_value)
+    conn.transaction(incrbyfloat, name)
+
+
+def watch_hincrbyfloat(conn, name, key, amount):
+    """
+    Optimistic hash float increment for servers without HINCRBYFLOAT
+    """
+    def hincrbyfloat(pipe):
+        current_value = pipe.hget(name, key)
+        if current_value is None:
+            current_value = 0.0
+        new_value = float(current_value) + amount
+        pipe.multi()
+        pipe.hset(name, key, new_value)
+    conn.transaction(hincrbyfloat, name)
+
+
+class WriteBuffer:
+    """
+    Collects the writes of one or more transactions in memory, coalescing
+    writes to the same key, and sends them in a single MULTI/EXEC pipeline.
+
+    Exposes the subset of the pipeline interface used by the measuring
+    functions, so it can be handed to them in place of a pipeline.
+
+    >>> buf = WriteBuffer()
+    >>> for i in range(500):
+    ...     _ = buf.incr("Visits:Date:20111021")
+    >>> buf.decr("Visits:Date:20111021", 20)
+    >>> buf.counters
+    {'Visits:Date:20111021': 480}
+
+    >>> buf.sadd("Patients:Date:20111021", 1, 2)
+    >>> buf.sadd("Patients:Date:20111021", 2, 3)
+    >>> sorted(buf.sets["Patients:Date:20111021"])
+    [1, 2, 3]
+
+    >>> buf.pfadd("Visitors:Date:20111021", 1, 2)
+    >>> buf.pfadd("Visitors:Date:20111021", 2, 3)
+    >>> sorted(buf.hyperloglogs["Visitors:Date:20111021"])
+    [1, 2, 3]
+
+    >>> other = WriteBuffer()
+    >>> other.incr("Visits:Date:20111021", 20)
+    >>> other.hincrby("RefCount:Date:20111021:Practice", "1", 1)
+    >>> buf.update(other)
+    >>> buf.counters
+    {'Visits:Date:20111021': 500}
+    >>> buf.hash_counters
+    {('RefCount:Date:20111021:Practice', '1'): 1}
+    """
+    def __init__(self):
+        self.counters = {}
+        self.float_counters = {}
+        self.hash_counters = {}
+        self.float_hash_counters = {}
+        self.sets = {}
+        self.hyperloglogs = {}
+        self.errors = []
+
+    def incr(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def decr(self, name, amount=1):
+        self.incr(name, -amount)
+
+    def incrbyfloat(self, name, amount=1.0):
+        self.float_counters[name] = \
+            self.float_counters.get(name, 0.0) + amount
+
+    def hincrby(self, name, key, amount=1):
+        self.hash_counters[(name, key)] = \
+            self.hash_counters.get((name, key), 0) + amount
+
+    def hincrbyfloat(self, name, key, amount=1.0):
+        self.float_hash_counters[(name, key)] = \
+            self.float_hash_counters.get((name, key), 0.0) + amount
+
+    def sadd(self, name, *values):
+        self.sets.setdefault(name, set()).update(values)
+
+    def pfadd(self, name, *values):
+        self.hyperloglogs.setdefault(name, set()).update(values)
+
+    def update(self, other):
+        """
+        Merges the writes buffered in other into this buffer
+        """
+        for name, amount in other.counters.iteritems():
+            self.incr(name, amount)
+        for name, amount in other.float_counters.iteritems():
+            self.incrbyfloat(name, amount)
+        for (name, key), amount in other.hash_counters.iteritems():
+            self.hincrby(name, key, amount)
+        for (name, key), amount in other.float_hash_counters.iteritems():
+            self.hincrbyfloat(name, key, amount)
+        for name, values in other.sets.iteritems():
+            self.sadd(name, *values)
+        for name, values in other.hyperloglogs.iteritems():
+            self.pfadd(name, *values)
+
+    def __len__(self):
+        return len(self.counters) + len(self.float_counters) + \
+            len(self.hash_counters) + len(self.float_hash_counters) + \
+            len(self.sets) + len(self.hyperloglogs)
+
+    def execute(self, conn, native_float=True):
+        """
+        Sends the buffered writes through a pipeline on conn.
+        Writes that coalesced to a zero increment are not sent.
+        Float increments use INCRBYFLOAT and HINCRBYFLOAT unless
+        native_float is False, in which case they fall back to a WATCH
+        transaction per key.
+        Redis applies the other commands of a MULTI when one fails, so
+        failures aren't raised: they are left in errors as (command, key,
+        error) for the caller to report.
+        Returns a dictionary of (name, key) -> value for hash increments.
+        """
+        pipe = conn.pipeline()
+        commands = []
+
+        def send(command, name, *args):
+            getattr(pipe, command)(name, *args)
+            commands.append((command, name))
+
+        hash_keys = []
+        for (name, key), amount in self.hash_counters.iteritems():
+            if amount != 0:
+                send("hincrby", name, key, amount)
+                hash_keys.append((name, key))
+        for name, amount in self.counters.iteritems():
+            if amount != 0:
+                send("incr", name, amount)
+        if native_float:
+            for name, amount in self.float_counters.iteritems():
+                if amount != 0:
+                    send("incrbyfloat", name, amount)
+            for (name, key), amount in self.float_hash_counters.iteritems():
+                if amount != 0:
+                    send("hincrbyfloat", name, key, amount)
+        for name, values in self.sets.iteritems():
+            send("sadd", name, *values)
+        for name, values in self.hyperloglogs.iteritems():
+            send("pfadd", name, *values)
+        values = pipe.execute(raise_on_error=False)
+        self.errors = [(command, name, value)
+                       for (command, name), value in zip(commands, values)
+                       if isinstance(value, Exception)]
+        if not native_float:
+            for name, amount in self.float_counters.iteritems():
+                if amount != 0:
+                    watch_incrbyfloat(conn, name, amount)
+            for (name, key), amount in self.float_hash_counters.iteritems():
+                if amount != 0:
+                    watch_hincrbyfloat(conn, name, key, amount)
+        return dict(zip(hash_keys, values))
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+"""
+Serves the r5d4 app from a gevent WSGI server. Blocking Redis calls yield
+to other requests, so one process handles many requests at once, and
+browse fetches run concurrently. Needs gevent.
+"""
+from __future__ import absolute_import
+from gevent import monkey
+
+
+if __name__ == "__main__":
+    # Sockets have to be patched before redis-py and flask are imported
+    monkey.patch_all()
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    import r5d4.settings as settings
+    from r5d4 import app
+
+    server = WSGIServer((settings.GEVENT_HOST, settings.GEVENT_PORT), app,
+                        spawn=Pool(settings.GEVENT_CONCURRENCY), log=None)
+    server.serve_forever()
@@ -3,6 +3,27 @@ from __future__ import absolute_import
 import redis
 import sys
 
+# Keys read and written per SCAN step
+CHUNK_SIZE = 1000
+
+# Key of temp_db holding "<step> <cursor>" of the running merge, where
+# cursor is "done" once the step completed
+PROGRESS_KEY = "AddKeys:Progress"
+
+# Set of temp_db holding the keys of source_db already added, as SCAN may
+# return a key more than once
+MERGED_KEY = "AddKeys:Merged"
+
+# Steps of a merge, in order: destination_db is cloned to temp_db, the
+# keys of source_db are added to it, and temp_db is cloned back
+STEPS = ["clone", "add", "copy"]
+
+# Prefix of the values of HyperLogLog strings
+HLL_PREFIX = "HYLL"
+
+# Where a HyperLogLog is written before being merged into its key
+HLL_MERGE_KEY = "AddKeys:Merging:%s"
+
 
 class UnsupportedKeyType(Exception):
     def __init__(self, key_type, key):
@@ -16,6 +37,23 @@ class UnsupportedKeyType(Exception):
         return self.__unicode__()
 
 
+class TypeMismatch(Exception):
+    def __init__(self, key, key_type, dest_type):
+        self.key = key
+        self.key_type = key_type
+        self.dest_type = dest_type
+
+    def __unicode__(self):
+        return "Can't add %s key '%s' to a %s" % (
+            self.key_type,
+            self.key,
+            self.dest_type
+        )
+
+    def __str__(self):
+        return self.__unicode__()
+
+
 class NotANumber(Exception):
     def __init__(self, key, value):
         self.key = key
@@ -37,100 +75,229 @@ def redis_conn(unix_socket_path, db):
     return conn
 
 
-def incr_by_float(conn, key, value):
-    def incrbyfloat(pipe):
-        current_value = float(pipe.get(key))
-        new_value = current_value + value
-        if new_value == int(new_value):
-            new_value = int(new_value)
-        pipe.multi()
-        pipe.set(key, new_value)
-    conn.transaction(incrbyfloat, key)
-
-
-def hincr_by_float(conn, key, hkey, hval):
-    def incrbyfloat(pipe):
-        current_value = float(pipe.hget(key, hkey))
-        new_value = current_value + hval
-        if new_value == int(new_value):
-            new_value = int(new_value)
-        pipe.multi()
-        pipe.hset(key, hkey, new_value)
-    conn.transaction(incrbyfloat, key)
-
-
-def clone_db(source_socket, destination_socket, source_db, destination_db):
-    src = redis_conn(source_socket, source_db)
-    dest = redis_conn(destination_socket, destination_db)
-    dest.flushdb()
-    keys = src.keys()
+def to_number(value):
+    """
+    Returns value as a float, or None if it isn't a number INCRBYFLOAT
+    takes
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    if number != number or number in (float("inf"), float("-inf")):
+        return None
+    return number
+
+
+def scan_chunks(conn, cursor=0):
+    """
+    Yields (cursor, keys) for every SCAN step of conn starting at cursor,
+    cursor being where the next step starts. The last one has cursor 0.
+    """
+    while True:
+        cursor, keys = conn.scan(cursor, count=CHUNK_SIZE)
+        yield int(cursor), [key for key in keys
+                            if key not in (PROGRESS_KEY, MERGED_KEY)]
+        if int(cursor) == 0:
+            return
+
+
+def fetch_chunk(conn, keys):
+    """
+    Returns (key, type, value) for keys, read with a pipeline of TYPEs
+    then a pipeline of reads. Keys deleted meanwhile are left out.
+    """
+    # A SCAN step may return a key twice
+    keys = sorted(set(keys))
+    pipe = conn.pipeline(transaction=False)
     for key in keys:
-        key_type = src.type(key)
+        pipe.type(key)
+    typed_keys = []
+    for key, key_type in zip(keys, pipe.execute()):
         if key_type == "string":
-            dest.set(key, src.get(key))
+            pipe.get(key)
         elif key_type == "set":
-            for sval in src.smembers(key):
-                dest.sadd(key, sval)
+            pipe.smembers(key)
         elif key_type == "hash":
-            for hkey, hval in src.hgetall(key).iteritems():
-                dest.hset(key, hkey, hval)
+            pipe.hgetall(key)
+        elif key_type == "none":
+            continue
         else:
             raise UnsupportedKeyType(key_type, key)
+        typed_keys.append((key, key_type))
+    # Empty strings are values, empty sets and hashes deleted keys
+    return [(key, key_type, value) for (key, key_type), value
+            in zip(typed_keys, pipe.execute())
+            if value is not None and (key_type == "string" or value)]
 
 
-def add_db(source_socket, destination_socket, source_db, destination_db):
-    src = redis_conn(source_socket, source_db)
-    dest = redis_conn(destination_socket, destination_db)
-    keys = src.keys()
-    for key in keys:
-        key_type = src.type(key)
+def clone_chunk(dest, items, pipe):
+    for key, key_type, value in items:
         if key_type == "string":
-            value = src.get(key)
-            if dest.exists(key):
-                try:
-                    float_val = float(value)
-                    incr_by_float(dest, key, float_val)
-                except ValueError:
-                    raise NotANumber(key, value)
-            else:
-                dest.set(key, value)
+            pipe.set(key, value)
         elif key_type == "set":
-            value = src.smembers(key)
-            for sval in value:
-                dest.sadd(key, sval)
+            pipe.sadd(key, *value)
         elif key_type == "hash":
-            value = src.hgetall(key)
-            if dest.exists(key):
-                for hkey, hval in value.iteritems():
-                    if dest.hexists(key, hkey):
-                        try:
-                            float_val = float(hval)
-                            hincr_by_float(dest, key, hkey, float_val)
-                        except ValueError:
-                            raise NotANumber("->".join([key, hkey]), hval)
-                    else:
-                        dest.hset(key, hkey, hval)
+            pipe.hmset(key, value)
+
+
+def check_addable(key, value, current):
+    """
+    Raises unless value can be added to current, the value of key in the
+    destination or None
+    """
+    if current is None:
+        return
+    value_hll = value.startswith(HLL_PREFIX)
+    current_hll = current.startswith(HLL_PREFIX)
+    if value_hll != current_hll:
+        kinds = {True: "HyperLogLog", False: "string"}
+        raise TypeMismatch(key, kinds[value_hll], kinds[current_hll])
+    elif value_hll:
+        return
+    elif to_number(value) is None:
+        raise NotANumber(key, value)
+    elif to_number(current) is None:
+        raise NotANumber(key, current)
+
+
+def add_chunk(dest, items, pipe):
+    """
+    Queues on pipe the writes adding items to dest: numbers are added,
+    sets and HyperLogLogs merged, and other strings set if dest doesn't
+    have them. Keys already in MERGED_KEY are skipped, the others are
+    added to it. Raises NotANumber or TypeMismatch before anything is
+    queued if dest holds values they can't be added to, so that no write
+    of the chunk fails once it is sent.
+    """
+    check = dest.pipeline(transaction=False)
+    for key, key_type, value in items:
+        check.sismember(MERGED_KEY, key)
+        check.type(key)
+        if key_type == "string":
+            check.get(key)
+        elif key_type == "hash":
+            check.hmget(key, value.keys())
+    # Reads of a key holding another type fail, its TYPE says why
+    results = iter(check.execute(raise_on_error=False))
+
+    merging = []
+    for key, key_type, value in items:
+        merged, dest_type = next(results), next(results)
+        if key_type in ("string", "hash"):
+            current = next(results)
+        if merged:
+            continue
+        if dest_type not in ("none", key_type):
+            raise TypeMismatch(key, key_type, dest_type)
+        if key_type == "string":
+            check_addable(key, value, current)
+        elif key_type == "hash":
+            for (hkey, hval), hcurrent in zip(value.items(), current):
+                check_addable("->".join([key, hkey]), hval, hcurrent)
+        merging.append((key, key_type, value))
+
+    for key, key_type, value in merging:
+        if key_type == "string":
+            if value.startswith(HLL_PREFIX):
+                merged_key = HLL_MERGE_KEY % key
+                pipe.set(merged_key, value)
+                pipe.pfmerge(key, merged_key)
+                pipe.delete(merged_key)
+            elif to_number(value) is None:
+                pipe.set(key, value)
             else:
-                for hkey, hval in value.iteritems():
-                    dest.hset(key, hkey, hval)
+                pipe.incrbyfloat(key, to_number(value))
+        elif key_type == "set":
+            pipe.sadd(key, *value)
+        elif key_type == "hash":
+            for hkey, hval in value.iteritems():
+                if to_number(hval) is None:
+                    pipe.hset(key, hkey, hval)
+                else:
+                    pipe.hincrbyfloat(key, hkey, to_number(hval))
+    if merging:
+        pipe.sadd(MERGED_KEY, *[key for key, key_type, value in merging])
+
+
+def copy_keys(src, dest, write_chunk, step, progress, cursor=0):
+    """
+    Writes the keys of src to dest with write_chunk, a SCAN step at a
+    time. The writes of a chunk go in one MULTI/EXEC, after which the
+    step and cursor are stored in PROGRESS_KEY of progress. When progress
+    is dest they are stored in the same transaction, so a resumed step
+    neither skips nor repeats a chunk. Otherwise they are stored once the
+    transaction succeeded, and a resumed step writes the last chunk again,
+    which only clone_chunk is used for.
+    """
+    copied = 0
+    for cursor, keys in scan_chunks(src, cursor):
+        items = fetch_chunk(src, keys)
+        state = "%s %s" % (step, cursor or "done")
+        pipe = dest.pipeline(transaction=True)
+        write_chunk(dest, items, pipe)
+        if progress is dest:
+            pipe.set(PROGRESS_KEY, state)
+        pipe.execute()
+        if progress is not dest:
+            progress.set(PROGRESS_KEY, state)
+        copied += len(items)
+        sys.stderr.write("%s: %d keys, cursor %d\n" % (step, copied, cursor))
+
+
+def clone_db(src, dest, step, progress, cursor=0):
+    if cursor == 0:
+        dest.flushdb()
+    copy_keys(src, dest, clone_chunk, step, progress, cursor)
+
+
+def add_db(src, dest, step, progress, cursor=0):
+    copy_keys(src, dest, add_chunk, step, progress, cursor)
+
+
+def merge(source, temp, destination, resume=False):
+    """
+    Adds the keys of source to destination through temp, resuming an
+    interrupted merge from the progress stored in temp if resume is True
+    """
+    steps = [(clone_db, destination, temp),
+             (add_db, source, temp),
+             (clone_db, temp, destination)]
+    start, cursor = 0, 0
+    if resume and temp.exists(PROGRESS_KEY):
+        step, position = temp.get(PROGRESS_KEY).split()
+        start = STEPS.index(step)
+        if position == "done":
+            start += 1
         else:
-            raise UnsupportedKeyType(key_type, key)
+            cursor = int(position)
+        sys.stderr.write("Resuming '%s' from cursor %d\n" % (
+            STEPS[min(start, len(STEPS) - 1)], cursor))
+    for i in xrange(start, len(steps)):
+        copy, src, dest = steps[i]
+        copy(src, dest, STEPS[i], temp, cursor)
+        cursor = 0
+    temp.delete(PROGRESS_KEY, MERGED_KEY)
 
 
 def display_usage():
     sys.stdout.write(
         "Usage %s <source_socket> <destination_socket> <source_db> <temp_db> "
-        "<destination_db>\n" % sys.argv[0])
+        "<destination_db> [--resume]\n" % sys.argv[0])
     sys.stdout.write(
         "WARNING: temp_db uses source_socket and existing keys will be "
-        "flushed.\n")
+        "flushed.\n"
+        "--resume carries on with an interrupted merge from where it "
+        "stopped.\n")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 6:
+    resume = "--resume" in sys.argv[6:]
+    if len(sys.argv) != 6 + resume:
         display_usage()
         sys.exit(0)
     source_socket, destination_socket, source_db, temp_db, destination_db = \
-        sys.argv[1:]
-    clone_db(destination_socket, source_socket, destination_db, temp_db)
-    add_db(source_socket, source_socket, source_db, temp_db)
-    clone_db(source_socket, destination_socket, temp_db, destination_db)
+        sys.argv[1:6]
+    merge(redis_conn(source_socket, source_db),
+          redis_conn(source_socket, temp_db),
+          redis_conn(destination_socket, destination_db),
+          resume)
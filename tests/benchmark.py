@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+import sys
+import time
+import random
+import redis
+from flask import json
+from r5d4.analytics import Analytics
+from r5d4.key_builder import KeyBuilder
+from r5d4.mapping_functions import MEASURING_FUNCTIONS_MAP,\
+    DIMENSION_PARSERS_MAP, unique
+from r5d4.test_settings import REDIS_HOST, REDIS_PORT
+from r5d4.utility import construct_key
+from r5d4.write_buffer import WriteBuffer
+
+SAMPLE_ANALYTICS = {
+    "name": "Appointments",
+    "measures": ["visits", "walkins", "revenue", "revenue_float",
+                 "patients", "heat"],
+    "query_dimensions": ["date", "practice", "doctor", "clinic"],
+    "slice_dimensions": ["date"],
+    "mapping": {
+        "visits": {"type": "count", "resource": "appointments"},
+        "walkins": {"type": "count", "resource": "appointments",
+                    "conditions": [{"field": "kind", "equals": "walkin"}]},
+        "revenue": {"type": "score", "resource": "appointments",
+                    "field": "amount"},
+        "revenue_float": {"type": "score_float", "resource": "appointments",
+                          "field": "famount"},
+        "patients": {"type": "unique", "resource": "appointments",
+                     "field": "patient"},
+        "heat": {"type": "heat", "resource": "appointments"},
+        "date": {"type": "date", "field": "at"},
+        "practice": {"type": "integer", "field": "practice_id"},
+        "doctor": {"type": "integer", "field": "doctor_id"},
+        "clinic": {"type": "string", "field": "clinic"}
+    }
+}
+
+UNIQUE_ANALYTICS = {
+    "name": "Reach",
+    "measures": ["patients", "doctors", "kinds", "visits"],
+    "query_dimensions": ["date", "practice"],
+    "slice_dimensions": ["date", "clinic"],
+    "mapping": {
+        "patients": {"type": "unique", "resource": "appointments",
+                     "field": "patient"},
+        "doctors": {"type": "unique", "resource": "appointments",
+                    "field": "doctor_id"},
+        "kinds": {"type": "unique", "resource": "appointments",
+                  "field": "kind"},
+        "visits": {"type": "count", "resource": "appointments"},
+        "date": {"type": "date", "field": "at"},
+        "practice": {"type": "integer", "field": "practice_id"},
+        "clinic": {"type": "string", "field": "clinic"}
+    }
+}
+
+
+def sample_messages(count, seed=0):
+    rnd = random.Random(seed)
+    messages = []
+    for i in xrange(count):
+        transaction = {
+            "at": "2011-10-%02d %02d:%02d:00" % (rnd.randint(1, 28),
+                                                 rnd.randint(0, 23),
+                                                 rnd.randint(0, 59)),
+            "practice_id": rnd.randint(1, 50),
+            "doctor_id": rnd.randint(1, 200),
+            "clinic": rnd.choice(["north", "south", "east", "west"]),
+            "kind": rnd.choice(["walkin", "booked"]),
+            "amount": rnd.randint(1, 1000),
+            "famount": rnd.randint(1, 4000) / 4.0,
+            "patient": rnd.randint(1, 10000)
+        }
+        messages.append({
+            "type": "message",
+            "channel": "appointments",
+            "data": json.dumps({"tr_type": "insert", "payload": transaction})
+        })
+    return messages
+
+
+def legacy_consume(analytics, content, pipe):
+    """
+    Per-message derivation done by actual_worker before AnalyticsPlan
+    """
+    measures = set(analytics["measures"])
+    query_dimensions = set(analytics["query_dimensions"])
+    slice_dimensions = set(analytics["slice_dimensions"])
+    mapping = analytics["mapping"]
+    data = json.loads(content["data"])
+    transaction = data["payload"]
+    tr_type = data["tr_type"]
+
+    snoq_dimensions = slice_dimensions - query_dimensions
+    qnos_dimensions = query_dimensions - slice_dimensions
+
+    def build_key_str(dimensions):
+        key = []
+        for dimension in sorted(list(dimensions)):
+            d_type = mapping[dimension]["type"]
+            function = DIMENSION_PARSERS_MAP[d_type]
+            field = mapping[dimension]["field"]
+            key.append(dimension)
+            key.append(function(transaction[field]))
+        return construct_key(key)
+
+    query_key_str = build_key_str(query_dimensions)
+    slice_key_str = build_key_str(slice_dimensions)
+    snoq_key_str = build_key_str(snoq_dimensions)
+
+    for dimension in sorted(list(qnos_dimensions)):
+        field = mapping[dimension]["field"]
+        ref_count_key = construct_key('RefCount', slice_key_str, dimension)
+        if tr_type == "insert":
+            pipe.hincrby(ref_count_key, transaction[field], 1)
+        elif tr_type == "delete":
+            pipe.hincrby(ref_count_key, transaction[field], -1)
+
+    for m in measures:
+        if mapping[m]["resource"] != content["channel"]:
+            continue
+        key_str = construct_key(m, query_key_str, snoq_key_str)
+        function = MEASURING_FUNCTIONS_MAP[mapping[m]["type"]]
+        field = mapping[m].get("field", None)
+        conditions = mapping[m].get("conditions", [])
+        kwargs = {
+            "key_str": key_str,
+        }
+        for condition in conditions:
+            condition_field = condition["field"]
+            equals = condition.get("equals", None)
+            not_equals = condition.get("not_equals", None)
+            if equals is not None:
+                if transaction[condition_field] != equals:
+                    break
+            elif not_equals is not None:
+                if transaction[condition_field] == not_equals:
+                    break
+        else:
+            if field is not None:
+                kwargs["field_val"] = transaction[field]
+            function(pipe, tr_type, **kwargs)
+
+
+def legacy_unique(pipe, tr_type, **kwargs):
+    """
+    unique measure from when measuring functions returned a value
+    """
+    pipe.sadd(kwargs["key_str"], kwargs["field_val"])
+    return pipe.scard(kwargs["key_str"])
+
+
+def plan_consume(plan, content, pipe):
+    data = json.loads(content["data"])
+    plan.apply(pipe, content["channel"], data["tr_type"], data["payload"])
+
+
+def report(name, count, seconds, unit):
+    sys.stdout.write("%-24s %12.0f %s/sec\n" % (name, count / seconds, unit))
+
+
+def benchmark_worker(count=20000):
+    """
+    Messages/sec of one worker's CPU path, writes go to a WriteBuffer
+    """
+    analytics = Analytics(json.dumps(SAMPLE_ANALYTICS))
+    messages = sample_messages(count)
+
+    pipe = WriteBuffer()
+    start = time.time()
+    for content in messages:
+        legacy_consume(analytics, content, pipe)
+    report("worker (per-message)", count, time.time() - start, "msgs")
+
+    plan = analytics.compile()
+    pipe = WriteBuffer()
+    start = time.time()
+    for content in messages:
+        plan_consume(plan, content, pipe)
+    report("worker (compiled plan)", count, time.time() - start, "msgs")
+
+
+def benchmark_unique(db, count=20000, batch_size=100):
+    """
+    Messages/sec written to Redis by a unique-heavy analytics, one pipeline
+    per batch, with and without the SCARD unique used to queue. Writes to
+    db of the test Redis server, which has to be empty and is flushed.
+    """
+    analytics = Analytics(json.dumps(UNIQUE_ANALYTICS))
+    messages = sample_messages(count)
+    conn = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=db)
+    if conn.dbsize() > 0:
+        sys.stderr.write("Redis db %d isn't empty, not benchmarking "
+                         "unique\n" % db)
+        sys.exit(1)
+
+    legacy_plan = analytics.compile()
+    legacy_plan.measures_by_channel = dict(
+        (channel, tuple((m, legacy_unique if function is unique else function,
+                         field, predicate)
+                        for m, function, field, predicate in measures))
+        for channel, measures in legacy_plan.measures_by_channel.iteritems())
+
+    for name, plan in (("unique (SADD+SCARD)", legacy_plan),
+                       ("unique (SADD)", analytics.compile())):
+        conn.flushdb()
+        start = time.time()
+        for i in xrange(0, count, batch_size):
+            pipe = conn.pipeline(transaction=False)
+            for content in messages[i:i + batch_size]:
+                plan_consume(plan, content, pipe)
+            pipe.execute()
+        report(name, count, time.time() - start, "msgs")
+    conn.flushdb()
+
+
+def sample_values(count, seed=0):
+    """
+    Parsed dimension values of SAMPLE_ANALYTICS transactions
+    """
+    analytics = Analytics(json.dumps(SAMPLE_ANALYTICS))
+    plan = analytics.compile()
+    values = []
+    for content in sample_messages(count, seed):
+        transaction = json.loads(content["data"])["payload"]
+        values.append(dict((d, parser(transaction[field]))
+                           for d, field, parser in plan.dimensions))
+    return values
+
+
+def construct_keys(analytics, values):
+    """
+    Keys of one transaction as built with construct_key
+    """
+    query_dimensions = set(analytics["query_dimensions"])
+    slice_dimensions = set(analytics["slice_dimensions"])
+
+    def build_key_str(dimensions):
+        key = []
+        for dimension in sorted(list(dimensions)):
+            key.append(dimension)
+            key.append(values[dimension])
+        return construct_key(key)
+
+    query_key_str = build_key_str(query_dimensions)
+    slice_key_str = build_key_str(slice_dimensions)
+    snoq_key_str = build_key_str(slice_dimensions - query_dimensions)
+    keys = [construct_key('RefCount', slice_key_str, d)
+            for d in sorted(query_dimensions - slice_dimensions)]
+    keys.extend(construct_key(m, query_key_str, snoq_key_str)
+                for m in analytics["measures"])
+    return keys
+
+
+def builder_keys(analytics, keys, values):
+    """
+    Keys of one transaction as built with a KeyBuilder
+    """
+    query_key_str, slice_key_str, snoq_key_str = \
+        keys.transaction_keys(values)
+    built = [keys.refcount_key(slice_key_str, d)
+             for d in sorted(set(analytics["query_dimensions"]) -
+                             set(analytics["slice_dimensions"]))]
+    built.extend(keys.measure_key(m, query_key_str, snoq_key_str)
+                 for m in analytics["measures"])
+    return built
+
+
+def benchmark_keys(count=20000):
+    """
+    Keys/sec built for the worker, construct_key against KeyBuilder
+    """
+    analytics = Analytics(json.dumps(SAMPLE_ANALYTICS))
+    samples = sample_values(count)
+    keys = KeyBuilder(analytics["query_dimensions"],
+                      analytics["slice_dimensions"])
+
+    for values in samples[:100]:
+        assert construct_keys(analytics, values) == \
+            builder_keys(analytics, keys, values)
+
+    key_count = 0
+    start = time.time()
+    for values in samples:
+        key_count += len(construct_keys(analytics, values))
+    report("keys (construct_key)", key_count, time.time() - start, "keys")
+
+    key_count = 0
+    start = time.time()
+    for values in samples:
+        key_count += len(builder_keys(analytics, keys, values))
+    report("keys (KeyBuilder)", key_count, time.time() - start, "keys")
+
+
+BENCHMARKS = {
+    "keys": benchmark_keys,
+    "worker": benchmark_worker,
+}
+
+# Benchmarks writing to Redis, only run when named with the db they flush
+REDIS_BENCHMARKS = {
+    "unique": benchmark_unique,
+}
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] and args[0] in REDIS_BENCHMARKS:
+        if len(args) != 2 or not args[1].isdigit():
+            sys.stderr.write("Usage: %s %s <empty redis db>\n" % (
+                sys.argv[0], args[0]))
+            sys.exit(1)
+        REDIS_BENCHMARKS[args[0]](int(args[1]))
+        sys.exit(0)
+    names = args or sorted(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.stderr.write("Unknown benchmark '%s', choose from: %s\n" % (
+                name, ", ".join(sorted(BENCHMARKS.keys()) +
+                                ["%s <db>" % r_name for r_name in
+                                 sorted(REDIS_BENCHMARKS.keys())])))
+            sys.exit(1)
+        BENCHMARKS[name]()
@@ -17,6 +17,14 @@ def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(r5d4.utility))
     tests.addTests(doctest.DocTestSuite(r5d4.mapping_functions))
     tests.addTests(doctest.DocTestSuite(r5d4.analytics_browser))
+    tests.addTests(doctest.DocTestSuite(r5d4.write_buffer))
+    tests.addTests(doctest.DocTestSuite(r5d4.analytics_plan))
+    tests.addTests(doctest.DocTestSuite(r5d4.query_cache))
+    tests.addTests(doctest.DocTestSuite(r5d4.publisher))
+    tests.addTests(doctest.DocTestSuite(r5d4.transport))
+    tests.addTests(doctest.DocTestSuite(r5d4.key_builder))
+    tests.addTests(doctest.DocTestSuite(r5d4.hash_storage))
+    tests.addTests(doctest.DocTestSuite(r5d4.analytics_manager))
     return tests
 
 